@@ -1,3 +1,3 @@
-from _version import __version__  # NOQA avoids style check on this line
+from ._version import __version__  # NOQA avoids style check on this line
 __author__ = 'Emanuele Mason'
 __email__ = 'emanuele.mason@polimi.it'
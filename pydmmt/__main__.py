@@ -0,0 +1,8 @@
+"""The command line of pydmmt, as python -m pydmmt model.yml."""
+import sys
+
+from pydmmt.pydmmt import main
+
+if __name__ == "__main__":
+    sys.argv[0] = "python -m pydmmt"  # for the usage
+    main()
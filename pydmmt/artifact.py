@@ -0,0 +1,192 @@
+"""Compiled models: the state of a built Model in a binary file.
+
+The file starts with a magic number, the format version and the python
+version (major, minor) it was written with, followed by a JSON document (its
+length first, as a little-endian uint32) and by the arrays it refers to, as
+.npy arrays read with allow_pickle=False. The document describes the state
+of the model: plain data, tagged containers (tuples, sets, slices, ...) and
+the objects a model is made of (functions, variables, the dependency graph,
+...), of those classes only, restored without calling their constructors.
+The compiled code of the functions is stored with marshal, so that loading
+needs no YAML parsing nor AST compilation, but the same python version; the
+code is checked to use the names the functions can use only.
+"""
+from collections import OrderedDict
+import json
+import marshal
+import numpy
+import struct
+import sys
+import types
+
+from . import graph, lazy, linear, util
+
+MAGIC = b"PDMM"
+FORMAT = 3
+
+
+def _classes():
+    # the classes whose objects can be in a file, by name
+    from . import ode
+    return {cls.__name__: cls
+            for cls in (util.Variable, util.Function, graph.DependencyGraph,
+                        lazy.LazyEvaluator, linear.LinearRecurrence,
+                        ode.System, ode.Integral)}
+
+
+# attributes left out of the file: the syntax trees of the functions are
+# needed to build a model only
+_TRANSIENT = {"Function": {"tree"}}
+
+
+def _check_code(code):
+    # the code of a function reads its inputs and constants from self and
+    # calls the functions it accepts, nothing else
+    allowed = {"self", "inputs", "constants", "value"}
+    allowed |= set(util.Function.namespace) - {"__builtins__"}
+    unknown = set(code.co_names) - allowed
+    if unknown or code.co_varnames or \
+            any(isinstance(c, types.CodeType) for c in code.co_consts):
+        raise ValueError("Code of a compiled model using " +
+                         (", ".join(sorted(unknown)) or "nested code"))
+    return code
+
+
+class _Writer():
+    def __init__(self):
+        self.arrays = list()
+        self.ids = dict()
+        # what's encoded stays alive, so that ids aren't reused
+        self.kept = list()
+
+    def _remember(self, value):
+        self.ids[id(value)] = len(self.ids)
+        self.kept.append(value)
+        return self.ids[id(value)]
+
+    def _array(self, array):
+        self.arrays.append(numpy.ascontiguousarray(array))
+        return len(self.arrays) - 1
+
+    def encode(self, value):
+        if value is None or type(value) in (bool, int, float, str):
+            return value
+        if id(value) in self.ids:
+            return {"#": "ref", "id": self.ids[id(value)]}
+        if isinstance(value, numpy.generic):
+            return {"#": "scalar", "dtype": value.dtype.str,
+                    "value": value.item()}
+        if isinstance(value, slice):
+            return {"#": "slice", "items": [self.encode(value.start),
+                                            self.encode(value.stop),
+                                            self.encode(value.step)]}
+        node = {"id": self._remember(value)}
+        if isinstance(value, numpy.ndarray):
+            node.update({"#": "array", "array": self._array(value)})
+        elif isinstance(value, types.CodeType):
+            code = numpy.frombuffer(marshal.dumps(value), dtype=numpy.uint8)
+            node.update({"#": "code", "array": self._array(code)})
+        elif type(value) in (list, tuple, set):
+            node.update({"#": type(value).__name__,
+                         "items": [self.encode(item) for item in value]})
+        elif type(value) in (dict, OrderedDict):
+            node.update({"#": type(value).__name__,
+                         "items": [[self.encode(k), self.encode(v)]
+                                   for k, v in value.items()]})
+        elif _classes().get(type(value).__name__) is type(value):
+            name = type(value).__name__
+            transient = _TRANSIENT.get(name, set())
+            node.update({"#": "object", "class": name,
+                         "items": [[k, self.encode(v)]
+                                   for k, v in vars(value).items()
+                                   if k not in transient]})
+        else:
+            raise TypeError("A compiled model can't hold a " +
+                            type(value).__name__)
+        return node
+
+
+class _Reader():
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.objects = dict()
+        self.classes = _classes()
+
+    def decode(self, node):
+        if not isinstance(node, dict):
+            return node
+        tag = node["#"]
+        if tag == "ref":
+            return self.objects[node["id"]]
+        if tag == "scalar":
+            return numpy.dtype(node["dtype"]).type(node["value"])
+        if tag == "slice":
+            return slice(*(self.decode(item) for item in node["items"]))
+        if tag == "array":
+            value = self.arrays[node["array"]]
+        elif tag == "code":
+            value = _check_code(
+                marshal.loads(self.arrays[node["array"]].tobytes()))
+        elif tag == "tuple":
+            value = tuple(self.decode(item) for item in node["items"])
+        else:
+            if tag == "object":
+                cls = self.classes[node["class"]]
+                value = cls.__new__(cls)
+            else:
+                value = {"list": list, "set": set, "dict": dict,
+                         "OrderedDict": OrderedDict}[tag]()
+            # remembered before the items, that may refer to it
+            self.objects[node["id"]] = value
+            items = node["items"]
+            if tag == "object":
+                value.__dict__.update(
+                    (k, self.decode(v)) for k, v in items)
+            elif tag == "list":
+                value.extend(self.decode(item) for item in items)
+            elif tag == "set":
+                value.update(self.decode(item) for item in items)
+            else:
+                value.update((self.decode(k), self.decode(v))
+                             for k, v in items)
+        self.objects[node["id"]] = value
+        return value
+
+
+def dump(state, stream):
+    """Write the state (a dict) of a model to a binary stream."""
+    writer = _Writer()
+    document = {"state": writer.encode(state),
+                "arrays": len(writer.arrays)}
+    text = json.dumps(document).encode('utf-8')
+    stream.write(MAGIC + bytes([FORMAT]) + bytes(sys.version_info[:2]) +
+                 struct.pack('<I', len(text)))
+    stream.write(text)
+    for array in writer.arrays:
+        numpy.save(stream, array, allow_pickle=False)
+
+
+def load(stream):
+    """Read the state of a model from a binary stream written by dump."""
+    header = stream.read(len(MAGIC) + 3)
+    if header[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a compiled pydmmt model")
+    if len(header) <= len(MAGIC) or header[len(MAGIC)] != FORMAT:
+        raise ValueError("Unknown format of compiled model: " +
+                         str(header[len(MAGIC):len(MAGIC) + 1]))
+    version = tuple(header[len(MAGIC) + 1:])
+    if version != tuple(sys.version_info[:2]):
+        raise ValueError("Model compiled with python " +
+                         '.'.join(str(n) for n in version) +
+                         ": compile it again")
+    size = stream.read(4)
+    if len(size) < 4:
+        raise ValueError("Truncated compiled model")
+    size = struct.unpack('<I', size)[0]
+    document = json.loads(stream.read(size).decode('utf-8'))
+    try:
+        arrays = [numpy.load(stream, allow_pickle=False)
+                  for _ in range(document["arrays"])]
+    except EOFError:
+        raise ValueError("Truncated compiled model")
+    return _Reader(arrays).decode(document["state"])
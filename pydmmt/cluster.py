@@ -0,0 +1,272 @@
+"""Evaluate a model on many hosts: a coordinator and its workers over TCP.
+
+    python -m pydmmt.cluster work model.pdm --connect host:5000
+    python -m pydmmt.cluster coordinate --bind 0.0.0.0:5000 < inputs.txt
+
+The coordinator reads input values, a line each, groups them in units of
+--batch rows and hands them to the workers connected to it, printing the
+targets in the same order of the inputs. Each worker builds its model once
+(a compiled .pdm is the fastest to load) and evaluates units until the
+coordinator closes the connection; workers can join at any time.
+
+Units and results travel with the framed layout of protocol: a header frame
+[unit, rows] followed by a frame with the rows one after the other. A unit
+with a row that can't be evaluated gets back [unit, rows, row] instead,
+followed by the text of the error, a byte per value: the coordinator raises
+it to the caller of map, and the worker goes on with the next units. A worker
+has at most --window units in flight, and no more than --pending units are
+read from the input before their results are delivered. The units of a
+worker that disconnects, or that is silent for --timeout seconds, are given
+to the other workers.
+"""
+import itertools
+import numpy
+import queue
+import socket
+import sys
+import threading
+
+from . import protocol
+from .pydmmt import Model
+
+
+class Coordinator():
+    """Hand units of input rows to the workers, and collect their targets.
+
+    The coordinator listens on host:port (port 0 picks a free one, see
+    address) from its creation to close.
+    """
+
+    def __init__(self, host="localhost", port=0, batch=100, window=2,
+                 pending=None, timeout=None):
+        self.batch = batch
+        self.window = window
+        self.pending = pending or 64 * window
+        self.timeout = timeout
+        # (unit, map call, rows), lost units first as they have the lowest
+        # numbers
+        self._units = queue.PriorityQueue()
+        self._results = queue.Queue()
+        self._generation = 0
+        self._closed = threading.Event()
+        self._connections = list()
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen()
+        self.address = self._server.getsockname()[:2]
+        self._acceptor = threading.Thread(target=self._accept, daemon=True)
+        self._acceptor.start()
+
+    def map(self, points):
+        """Yield the targets of each row of points, in order.
+
+        points can be any iterable of rows, read only as fast as the results
+        are delivered. The units left by a previous call are dropped.
+        """
+        self._generation += 1
+        generation = self._generation
+        while not self._units.empty():
+            self._units.get()
+        total = list()
+        credit = threading.Semaphore(self.pending)
+        feeder = threading.Thread(target=self._feed,
+                                  args=(points, credit, total, generation),
+                                  daemon=True)
+        feeder.start()
+        ready = dict()
+        position = 0
+        while not total or position < total[0]:
+            unit, origin, targets = self._results.get()
+            if origin != generation:
+                continue
+            if unit is None:
+                raise targets  # the points couldn't be read
+            if isinstance(targets, Exception):
+                raise targets  # a row couldn't be evaluated
+            if unit < position or unit in ready:
+                continue  # evaluated twice: a worker was given up too soon
+            ready[unit] = targets
+            while position in ready:
+                yield from ready.pop(position)
+                position += 1
+                credit.release()
+
+    def close(self):
+        """Stop listening and disconnect the workers."""
+        self._closed.set()
+        self._server.close()
+        for connection in list(self._connections):
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _feed(self, points, credit, total, generation):
+        rows = iter(points)
+        unit = 0
+        try:
+            while True:
+                chunk = list(itertools.islice(rows, self.batch))
+                if not chunk:
+                    break
+                while not credit.acquire(timeout=0.1):
+                    if generation != self._generation or \
+                            self._closed.is_set():
+                        return  # map was left behind
+                self._units.put((unit, generation,
+                                 numpy.asarray(chunk, dtype=float)))
+                unit += 1
+        except Exception as error:
+            self._results.put((None, generation, error))
+        total.append(unit)
+        # wake up map if there's nothing to wait for
+        self._results.put((-1, generation, None))
+
+    def _accept(self):
+        while not self._closed.is_set():
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                return  # closed
+            connection.settimeout(self.timeout)
+            self._connections.append(connection)
+            threading.Thread(target=self._drive, args=(connection, ),
+                             daemon=True).start()
+
+    def _drive(self, connection):
+        # keep a worker busy with up to window units, which it evaluates in
+        # the order they're sent
+        stream = connection.makefile("rwb")
+        in_flight = list()
+        try:
+            while not self._closed.is_set():
+                while len(in_flight) < self.window:
+                    try:
+                        item = self._units.get(timeout=0.1
+                                               if not in_flight else 0)
+                    except queue.Empty:
+                        break
+                    in_flight.append(item)
+                    unit, _, rows = item
+                    protocol.write_frame(stream, [unit, len(rows)])
+                    protocol.write_frame(stream, rows.ravel())
+                    stream.flush()
+                if not in_flight:
+                    continue
+                header = protocol.read_frame(stream)
+                if header is None:
+                    break  # the worker is gone
+                size = int(header[1])
+                values = protocol.read_frame(stream)
+                if values is None:
+                    break
+                unit, generation, _ = in_flight.pop(0)
+                if unit != int(header[0]):
+                    raise ValueError("Unit " + str(int(header[0])) +
+                                     " out of order")
+                if len(header) > 2:
+                    text = bytes(values.astype(numpy.uint8)).decode(
+                        'utf-8', 'replace')
+                    self._results.put((unit, generation, ValueError(
+                        "Row " + str(unit * self.batch + int(header[2])) +
+                        " of the points can't be evaluated: " + text)))
+                    continue
+                self._results.put((unit, generation,
+                                   list(values.reshape(size, -1))))
+        except (OSError, EOFError, ValueError):
+            pass  # disconnected, timed out or garbled: the same for us
+        finally:
+            for item in in_flight:
+                if item[1] == self._generation:
+                    self._units.put(item)
+            if connection in self._connections:
+                self._connections.remove(connection)
+            connection.close()
+
+
+def work(sources, address):
+    """Evaluate the units sent from the coordinator at address, until it's
+    done with this worker.
+
+    Returns the number of rows evaluated. A row that raises is reported to
+    the coordinator with its unit, and the next units are evaluated all the
+    same.
+    """
+    model = Model({"sources": list(sources)})
+    done = 0
+    with socket.create_connection(address) as connection:
+        stream = connection.makefile("rwb")
+        while True:
+            header = protocol.read_frame(stream)
+            if header is None:
+                return done
+            size = int(header[1])
+            values = protocol.read_frame(stream)
+            if values is None:
+                return done
+            rows = values.reshape(size, model.input_size)
+            targets = list()
+            try:
+                for row in rows:
+                    targets.append(model.process_values(row))
+            except Exception as error:
+                text = type(error).__name__ + ": " + str(error)
+                protocol.write_frame(stream, [header[0], size, len(targets)])
+                protocol.write_frame(stream, numpy.frombuffer(
+                    text.encode('utf-8'), dtype=numpy.uint8))
+            else:
+                protocol.write_frame(stream, header)
+                protocol.write_frame(stream, numpy.ravel(targets))
+            stream.flush()
+            done += len(targets)
+
+
+def _address(text):
+    host, _, port = text.rpartition(':')
+    return host or "localhost", int(port)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m pydmmt.cluster")
+    roles = parser.add_subparsers(dest="role")
+    roles.required = True
+    worker = roles.add_parser("work", help="Evaluate units of a coordinator")
+    worker.add_argument("sources",
+                        help="Any file containing the model specification",
+                        nargs='+')
+    worker.add_argument("--connect", type=_address, required=True,
+                        help="host:port of the coordinator")
+    coordinator = roles.add_parser("coordinate",
+                                   help="Evaluate the inputs read from stdin"
+                                        " on the workers")
+    coordinator.add_argument("--bind", type=_address, default="localhost:0",
+                             help="host:port to listen on")
+    coordinator.add_argument("--batch", type=int, default=100,
+                             help="Rows in a unit of work")
+    coordinator.add_argument("--window", type=int, default=2,
+                             help="Units in flight on each worker")
+    coordinator.add_argument("--pending", type=int, default=None,
+                             help="Units read ahead of the results")
+    coordinator.add_argument("--timeout", type=float, default=None,
+                             help="Seconds a worker may be silent")
+    args = parser.parse_args(argv)
+
+    if args.role == "work":
+        work(args.sources, args.connect)
+        return
+    with Coordinator(args.bind[0], args.bind[1], args.batch, args.window,
+                     args.pending, args.timeout) as coordinator:
+        print("listening on %s:%d" % coordinator.address, file=sys.stderr)
+        points = ([float(el) for el in line.split()] for line in sys.stdin)
+        for targets in coordinator.map(points):
+            print(' '.join([str(el) for el in targets]))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
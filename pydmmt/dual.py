@@ -0,0 +1,174 @@
+"""Dual numbers for the forward-mode differentiation of a model."""
+import math
+import numpy
+
+from . import kernels
+
+
+class Dual():
+    """A value together with its derivatives with respect to the inputs.
+
+    tangent is a numpy array with one derivative per input value (or 0 for a
+    constant). Comparisons only look at the value, so that max, min and if
+    expressions pick the derivative of the branch taken (a subgradient).
+    """
+    __slots__ = ("value", "tangent")
+
+    def __init__(self, value, tangent=0):
+        self.value = value
+        self.tangent = tangent
+
+    def __repr__(self):
+        return "Dual(" + repr(self.value) + ", " + repr(self.tangent) + ")"
+
+    def __float__(self):
+        return float(self.value)
+
+    def __add__(self, other):
+        if isinstance(other, Dual):
+            return Dual(self.value + other.value, self.tangent + other.tangent)
+        return Dual(self.value + other, self.tangent)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, Dual):
+            return Dual(self.value - other.value, self.tangent - other.tangent)
+        return Dual(self.value - other, self.tangent)
+
+    def __rsub__(self, other):
+        return Dual(other - self.value, -self.tangent)
+
+    def __mul__(self, other):
+        if isinstance(other, Dual):
+            return Dual(self.value * other.value,
+                        self.tangent * other.value +
+                        self.value * other.tangent)
+        return Dual(self.value * other, self.tangent * other)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if isinstance(other, Dual):
+            return Dual(self.value / other.value,
+                        (self.tangent * other.value -
+                         self.value * other.tangent) / other.value ** 2)
+        return Dual(self.value / other, self.tangent / other)
+
+    def __rtruediv__(self, other):
+        return Dual(other / self.value,
+                    -other * self.tangent / self.value ** 2)
+
+    def __floordiv__(self, other):
+        return Dual(self.value // _value(other))
+
+    def __rfloordiv__(self, other):
+        return Dual(other // self.value)
+
+    def __mod__(self, other):
+        if isinstance(other, Dual):
+            return Dual(self.value % other.value,
+                        self.tangent -
+                        (self.value // other.value) * other.tangent)
+        return Dual(self.value % other, self.tangent)
+
+    def __rmod__(self, other):
+        return Dual(other % self.value,
+                    -(other // self.value) * self.tangent)
+
+    def __pow__(self, other):
+        if isinstance(other, Dual):
+            value = self.value ** other.value
+            return Dual(value,
+                        _base(self.value, other.value, self.tangent) +
+                        _exponent(value, self.value, other))
+        return Dual(self.value ** other,
+                    _base(self.value, other, self.tangent))
+
+    def __rpow__(self, other):
+        value = other ** self.value
+        return Dual(value, _exponent(value, other, self))
+
+    def __neg__(self):
+        return Dual(-self.value, -self.tangent)
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return self if self.value >= 0 else -self
+
+    def __lt__(self, other):
+        return self.value < _value(other)
+
+    def __le__(self, other):
+        return self.value <= _value(other)
+
+    def __gt__(self, other):
+        return self.value > _value(other)
+
+    def __ge__(self, other):
+        return self.value >= _value(other)
+
+    def __eq__(self, other):
+        return self.value == _value(other)
+
+    def __ne__(self, other):
+        return self.value != _value(other)
+
+    __hash__ = None
+
+    def exp(self):
+        value = math.exp(self.value)
+        return Dual(value, value * self.tangent)
+
+    def log(self):
+        return Dual(math.log(self.value), self.tangent / self.value)
+
+
+def _value(x):
+    return x.value if isinstance(x, Dual) else x
+
+
+def _base(base, exponent, tangent):
+    # the derivative of base ^ exponent through the base: infinite for base
+    # 0 and an exponent below 1 (but 0), an error of the policy in use (see
+    # kernels.py), only where the base moves
+    if base != 0 or exponent >= 1:
+        return exponent * base ** (exponent - 1) * tangent
+    if exponent == 0 or not numpy.any(tangent):
+        return 0
+    slope = exponent * kernels.power(base, exponent - 1)
+    with numpy.errstate(invalid="ignore"):
+        return numpy.where(numpy.not_equal(tangent, 0), slope * tangent, 0.)
+
+
+def _exponent(value, base, exponent):
+    # the derivative of value = base ^ exponent through the exponent: the
+    # logarithm of the base only if needed, and 0 for base 0 (positive
+    # exponent) or nan, only where the exponent moves, for the bases that
+    # have none
+    if not numpy.any(exponent.tangent):
+        return 0
+    if base > 0:
+        return value * math.log(base) * exponent.tangent
+    if base == 0 and exponent.value > 0:
+        return 0
+    return numpy.where(numpy.not_equal(exponent.tangent, 0), math.nan, 0.)
+
+
+def seed(values):
+    """Dual numbers for the values, each one the derivative variable."""
+    identity = numpy.eye(len(values))
+    return [Dual(float(v), identity[i]) for i, v in enumerate(values)]
+
+
+def split(results, size):
+    """Values and Jacobian (one row per result) of results."""
+    values, jacobian = list(), list()
+    for result in results:
+        for item in numpy.ravel(result):
+            values.append(float(item))
+            tangent = getattr(item, "tangent", 0)
+            jacobian.append(numpy.zeros(size) + tangent)
+    return numpy.array(values), numpy.array(jacobian).reshape(-1, size)
@@ -0,0 +1,66 @@
+"""Fill the gaps of the external data, once, as it's loaded.
+
+The steps of the timeline that no external source gives a value for (or
+gives an empty or nan one) are gaps: reading them is an error, unless the
+"gaps" section says how to fill them, by variable:
+
+    gaps:
+      i1: forward               # the last value given before
+      i2: linear                # interpolated between the values around
+      i3: {climatology: 12}     # the mean of the values given at the same
+                                # t modulo 12 (e.g. the month of the year)
+      i4: 0                     # a number
+
+Gaps before the first value given (forward) or outside the values given
+(linear), and phases with no value at all (climatology), stay gaps.
+"""
+import numbers
+import numpy
+
+
+def check(method):
+    """Raise ValueError if method isn't a known way to fill gaps."""
+    if isinstance(method, numbers.Number) and not isinstance(method, bool):
+        return
+    if method in ("forward", "linear"):
+        return
+    if isinstance(method, dict) and list(method) == ["climatology"] and \
+            int(method["climatology"]) > 0:
+        return
+    raise ValueError("Unknown way to fill gaps: " + str(method))
+
+
+def fill(values, known, method, times=None):
+    """Fill the gaps of values, where known is False, in place.
+
+    times are the values of t of each element (for climatology). Returns
+    the mask of the values known after filling.
+    """
+    check(method)
+    gaps = ~known
+    if not gaps.any():
+        return known
+    if isinstance(method, numbers.Number):
+        values[gaps] = method
+        return numpy.ones_like(known)
+    if not known.any():
+        return known
+    positions = numpy.arange(len(values))
+    if method == "forward":
+        last = numpy.maximum.accumulate(numpy.where(known, positions, -1))
+        filled = last >= 0
+        values[filled] = values[last[filled]]
+        return filled
+    if method == "linear":
+        given = positions[known]
+        inside = gaps & (positions > given[0]) & (positions < given[-1])
+        values[inside] = numpy.interp(positions[inside], given,
+                                      values[known])
+        return known | inside
+    period = int(method["climatology"])
+    phases = (positions if times is None else numpy.asarray(times)) % period
+    counts = numpy.bincount(phases[known], minlength=period)
+    sums = numpy.bincount(phases[known], values[known], minlength=period)
+    filled = gaps & (counts[phases] > 0)
+    values[filled] = sums[phases[filled]] / counts[phases[filled]]
+    return known | filled
@@ -0,0 +1,181 @@
+"""Dependency analysis of the equations of a pydmmt model."""
+from collections import OrderedDict
+
+
+class DependencyGraph():
+    """Graph of the variables of a model, as defined by its functions.
+
+    Nodes are variable names (indexes stripped), so that "h[t+1]", "h[t]" and
+    "h[0]" are the same node. Arcs go from a variable to the variables it
+    needs to be calculated.
+    """
+
+    def __init__(self, functions):
+        self.functions = functions
+        # maps names with the outputs defining them: "F" -> [F[t+2], F[0]]
+        self.definitions = dict()
+        # maps names with the names they depend on: "F" -> ["F"]
+        self.dependencies = dict()
+        for output, function in functions.items():
+            self.definitions.setdefault(output.name, []).append(output)
+            requirements = self.dependencies.setdefault(output.name, [])
+            requirements += [v.name for v in function.inputs
+                             if v.name not in requirements]
+
+    def required(self, names):
+        """The names transitively needed to evaluate the given ones."""
+        found = list()
+        todo = [n for n in names]
+        while todo:
+            name = todo.pop()
+            if name in found or name not in self.definitions:
+                continue
+            found.append(name)
+            todo += self.dependencies[name]
+        return found
+
+    def order(self, names):
+        """Sort the names so that dependencies come before their dependents.
+
+        Cycles (e.g. the state of a dynamic model depending on its own past)
+        are broken at the first variable visited.
+        """
+        ordered = list()
+        visiting = set()
+
+        def visit(name):
+            if name in ordered or name in visiting:
+                return
+            visiting.add(name)
+            for dependency in self.dependencies.get(name, []):
+                if dependency in names:
+                    visit(dependency)
+            ordered.append(name)
+
+        for name in names:
+            visit(name)
+        return ordered
+
+    def strands(self, names):
+        """Split names in independent strands, plus the ones they share.
+
+        Each strand is made by the names needed only by a single sink (a name
+        nothing else depends on), so that, once the shared names are known,
+        strands can be evaluated independently. Non indexed names aren't
+        known once for all, but computed again where they're read: strands
+        reading the same ones are merged. Returns the shared names and the
+        list of strands.
+        """
+        dependents = {name: set() for name in names}
+        for name in names:
+            for dependency in self.dependencies.get(name, []):
+                if dependency in dependents and dependency != name:
+                    dependents[dependency].add(name)
+        owners = {name: set() for name in names}
+        for sink in [name for name in names if not dependents[name]]:
+            for name in self.required([sink]):
+                if name in owners:
+                    owners[name].add(sink)
+        shared = [name for name in names if len(owners[name]) != 1]
+        strands = OrderedDict()
+        for name in names:
+            if len(owners[name]) == 1:
+                strands.setdefault(next(iter(owners[name])), []).append(name)
+        merged = list()
+        for strand in strands.values():
+            reads = self._non_indexed(strand)
+            for other in [item for item in merged if item[1] & reads]:
+                merged.remove(other)
+                strand = other[0] + strand
+                reads |= other[1]
+            merged.append((strand, reads))
+        return shared, [strand for strand, _ in merged]
+
+    def _non_indexed(self, names):
+        # the non indexed names computed to evaluate the given ones, the
+        # indexed ones being known
+        found = set()
+        todo = list(names)
+        while todo:
+            for dependency in self.dependencies.get(todo.pop(), []):
+                if dependency not in found and \
+                        dependency in self.definitions and \
+                        not any(v.is_indexed
+                                for v in self.definitions[dependency]):
+                    found.add(dependency)
+                    todo.append(dependency)
+        return found
+
+    def ranges(self, requests, bounds):
+        """Compute the minimal range of indexes each variable is needed on.
+
+        requests is a list of (name, lower, upper) tuples, e.g. the targets
+        and the logged variables; bounds is the (first, last) index of the
+        timeline. Indexed variables get the range of indexes that is read,
+        non indexed ones the range of steps they are evaluated at. Both
+        limits are inclusive.
+        """
+        found = dict()
+        todo = list(requests)
+        while todo:
+            name, lower, upper = todo.pop()
+            lower, upper = max(lower, bounds[0]), min(upper, bounds[1])
+            if name not in self.definitions or lower > upper:
+                continue
+            # only the part not yet known has to be propagated
+            if name in found:
+                old_lower, old_upper = found[name]
+                found[name] = (min(lower, old_lower), max(upper, old_upper))
+                news = [(lower, min(upper, old_lower - 1)),
+                        (max(lower, old_upper + 1), upper)]
+            else:
+                found[name] = (lower, upper)
+                news = [(lower, upper)]
+            for lower, upper in news:
+                if lower <= upper:
+                    todo += self._propagate(name, lower, upper, bounds)
+        return found
+
+    def _propagate(self, name, lower, upper, bounds):
+        # what the definitions of name need to cover the range lower:upper
+        requests = list()
+        for output in self.definitions[name]:
+            if not output.is_indexed:
+                steps = (lower, upper)
+            elif output.is_absolutely_indexed:
+                if not lower <= int(output.index) <= upper:
+                    continue
+                steps = (int(output.index), int(output.index))
+            else:
+                steps = (max(lower - output.delay, bounds[0]),
+                         min(upper - output.delay, bounds[1]))
+                if steps[0] > steps[1]:
+                    continue
+            requests += [self._input_range(output, v, steps, bounds)
+                         for v in self.functions[output].inputs]
+        return requests
+
+    @staticmethod
+    def index_range(v, bounds):
+        """The (name, lower, upper) range read by an absolutely indexed v."""
+        limits = v.index.split(':')
+        lower = int(limits[0]) if limits[0] else bounds[0]
+        if len(limits) == 1:
+            return (v.name, lower, lower)
+        upper = int(limits[1]) - 1 if limits[1] else bounds[1]
+        return (v.name, lower, upper)
+
+    @staticmethod
+    def _input_range(output, v, steps, bounds):
+        # the range of indexes of v read while evaluating output on steps
+        if not v.is_indexed:
+            return (v.name, steps[0], steps[1])
+        if v.is_absolutely_indexed:
+            return DependencyGraph.index_range(v, bounds)
+        if v.delay is None:  # relatively indexed slice: be conservative
+            return (v.name, bounds[0], bounds[1])
+        if (v.name == output.name and output.is_relatively_indexed and
+                v.delay < output.delay):
+            # a recurrence needs all its past: skip the step by step crawl
+            return (v.name, bounds[0], steps[1] + v.delay)
+        return (v.name, steps[0] + v.delay, steps[1] + v.delay)
@@ -0,0 +1,105 @@
+"""Receding horizon simulation of a model, e.g. for predictive control."""
+import numpy
+
+
+class RecedingHorizon():
+    """Simulate a model on a window sliding along time.
+
+    The model is written for the first window: its timeline, from the initial
+    conditions to the targets, is the horizon. The window is then moved along
+    time reusing the same model, sim_data included: the external data is
+    copied in from series indexed by time, the value of t is shifted, and the
+    initial conditions (the absolutely indexed functions, e.g. "h[0] = 100")
+    are seeded from the trajectory simulated in the previous window.
+    """
+
+    def __init__(self, model, external=None, shift=1):
+        if not model.sim_timeline:
+            raise ValueError("A receding horizon needs a dynamic model")
+        if not 0 < shift < len(model.sim_timeline):
+            raise ValueError("The shift must be within the horizon")
+        self.model = model
+        # the time origin is honored by the step by step engine only
+        model.evaluation = "eager"
+        self.shift = shift
+        self.first = model.sim_timeline[0]
+        self.size = len(model.sim_timeline)
+        names = model.sim_data.dtype.names
+        self.external = dict()
+        for name, series in (external or dict()).items():
+            if name not in names:
+                raise ValueError("Variable " + name + " isn't used")
+            self.external[name] = numpy.asarray(series, dtype=float)
+        # the initial conditions, and their values in the current window
+        self.initial = [(v.name, int(v.index)) for v in model.functions
+                        if v.is_absolutely_indexed and not v.is_sliced and
+                        v.name in names]
+        self.state = dict()
+        self.results = None
+        self._load_external()
+
+    @property
+    def origin(self):
+        """The time at the first index of the current window."""
+        return self.model.time_origin + self.first
+
+    def evaluate(self, candidates):
+        """Targets of the current window for each row of input values.
+
+        The candidates are simulated one after the other. Returns an array
+        with a row for each candidate, reused across calls with the same
+        number of candidates.
+        """
+        candidates = numpy.atleast_2d(numpy.asarray(candidates, dtype=float))
+        size = len(self.model.parameters["simulation"]["target"])
+        if self.results is None or self.results.shape[0] != len(candidates):
+            self.results = numpy.empty((len(candidates), size))
+        for i, values in enumerate(candidates):
+            self.results[i] = self._simulate(values)
+        return self.results
+
+    def advance(self, values, state=None):
+        """Move the window forward by shift steps.
+
+        The model is simulated with the chosen input values, then the initial
+        conditions of the next window are read from the trajectory. state can
+        override some of them with measured values: it maps names with the
+        value at the first index of the new window.
+        """
+        self._simulate(numpy.asarray(values, dtype=float))
+        sim_data = self.model.sim_data
+        self.state = {(name, index): sim_data[name][index + self.shift]
+                      for name, index in self.initial}
+        if state:
+            for name, value in state.items():
+                self.state[(name, self.first)] = value
+        self.model.time_origin += self.shift
+        self._load_external()
+
+    def _simulate(self, values):
+        model = self.model
+        if len(values) != model.input_size:
+            raise ValueError("Expected " + str(model.input_size) +
+                             " input values, got " + str(len(values)))
+        model._set_inputs(values.tolist())
+        # seeded cells are not computed again by the engine
+        for (name, index), value in self.state.items():
+            model._store(name, index, value)
+        model.run_simulation()
+        targets = numpy.hstack([model._calculate(y) for y
+                                in model.parameters["simulation"]["target"]])
+        # the errors of the targets computed after the steps (see kernels.py)
+        model.errors.check(" computing the targets")
+        return targets
+
+    def _load_external(self):
+        # the window of each external series, copied in place
+        start = self.origin
+        for name, series in self.external.items():
+            if start < 0 or start + self.size > len(series):
+                raise ValueError("The external data of " + name +
+                                 " doesn't cover the window at " + str(start))
+            self.model._store(name, slice(None),
+                              series[start:start + self.size])
+        # t and the initial conditions have moved too
+        self.model.forget_forcing()
@@ -0,0 +1,217 @@
+"""Numeric kernels of the expression language.
+
+The functions of the language (max, min, sum, mean, abs, power, exp, log,
+clip, where, ...) take numbers and numpy arrays alike. On numbers they give
+what python gives; on arrays the same, an element at a time, so that a model
+evaluated on columns of values (see table.py) gives the results of one
+evaluated a row at a time. Dual numbers (see dual.py) go through them too.
+
+Floating point errors (overflows, divisions by zero, invalid operations) of
+power, exp, log and sqrt don't raise within the kernels: they're counted by
+the Errors in use by the thread calling them (each model has its own), whose
+check raises them in bulk, e.g. once per step. The result of an operation
+in error depends on its policy:
+
+    "raise": the IEEE result (inf or nan), then check raises
+    "nan": nan
+    "clip": infinities are clipped to the largest finite floats, nan stays
+
+The arithmetic operators don't go through kernels, not to slow down every
+operation: their errors follow python, whatever the policy (division by
+zero raises ZeroDivisionError, overflows give inf).
+"""
+import builtins
+import numpy
+import threading
+
+POLICIES = ("raise", "nan", "clip")
+
+_LARGEST = numpy.finfo(float).max
+
+
+class Errors():
+    """The floating point errors of the evaluations of a model.
+
+    count is the number of errors since the last check.
+    """
+
+    def __init__(self, policy="raise"):
+        self.policy = policy
+        self.count = 0
+
+    def check(self, where=""):
+        """Raise FloatingPointError if any error happened since the last
+        check, and the policy is "raise"."""
+        count, self.count = self.count, 0
+        if count and self.policy == "raise":
+            raise FloatingPointError(str(count) +
+                                     " floating point error(s)" + where)
+
+
+# the Errors in use, by thread
+_local = threading.local()
+
+
+def use(errors):
+    """Count the errors of the kernels called by this thread in errors."""
+    _local.errors = errors
+
+
+def current():
+    """The Errors in use by this thread, a new one if none was given."""
+    try:
+        return _local.errors
+    except AttributeError:
+        _local.errors = Errors()
+        return _local.errors
+
+
+def _fix(value, policy):
+    # apply the policy to a result in error
+    if policy == "nan":
+        return value * numpy.nan
+    if policy == "clip":
+        return numpy.clip(value, -_LARGEST, _LARGEST)
+    return value
+
+
+def _ieee(ufunc, *operands):
+    # the ufunc, without raising nor warning: new non finite results are
+    # errors
+    with numpy.errstate(all="ignore"):
+        value = ufunc(*operands)
+    if numpy.asarray(value).dtype == object:  # e.g. dual numbers
+        return value
+    wrong = ~numpy.isfinite(value)
+    for operand in operands:
+        wrong &= numpy.isfinite(operand)
+    if not numpy.any(wrong):
+        return value
+    errors = current()
+    if numpy.ndim(value) == 0:
+        errors.count += 1
+        return _fix(value, errors.policy)
+    errors.count += int(numpy.count_nonzero(wrong))
+    value = numpy.array(value)
+    value[wrong] = _fix(value[wrong], errors.policy)
+    return value
+
+
+def _reduce(items, choose):
+    # elementwise max or min of arrays, as python compares the items
+    if len(items) == 1:
+        items = numpy.moveaxis(items[0], -1, 0)
+    result = items[0]
+    for item in items[1:]:
+        result = numpy.where(choose(item, result), item, result)
+    return result
+
+
+def max(*items):
+    """The largest of the items (or of the elements of a single vector)."""
+    if len(items) == 1:
+        if numpy.ndim(items[0]) < 2:
+            return builtins.max(items[0])
+    else:
+        for item in items:
+            if isinstance(item, numpy.ndarray):
+                break
+        else:
+            return builtins.max(items)
+    return _reduce(items, numpy.greater)
+
+
+def min(*items):
+    """The smallest of the items (or of the elements of a single vector)."""
+    if len(items) == 1:
+        if numpy.ndim(items[0]) < 2:
+            return builtins.min(items[0])
+    else:
+        for item in items:
+            if isinstance(item, numpy.ndarray):
+                break
+        else:
+            return builtins.min(items)
+    return _reduce(items, numpy.less)
+
+
+def sum(items):
+    """The sum of the elements of a vector, from left to right."""
+    if numpy.ndim(items) < 2:
+        return builtins.sum(items)
+    # numpy.sum adds pairwise, rounding differently
+    result = 0
+    for item in numpy.moveaxis(items, -1, 0):
+        result = result + item
+    return result
+
+
+def mean(items):
+    """The mean of the elements of a vector."""
+    return sum(items) / numpy.shape(items)[-1] \
+        if isinstance(items, numpy.ndarray) else sum(items) / len(items)
+
+
+def abs(x):
+    """The absolute value of x."""
+    if isinstance(x, numpy.ndarray):
+        return numpy.abs(x)
+    return builtins.abs(x)
+
+
+def power(a, b):
+    """a raised to b, as a ** b."""
+    if isinstance(a, numpy.ndarray) or isinstance(b, numpy.ndarray):
+        # numpy.power may round differently from python, this not
+        return _ieee(numpy.float_power, a, b)
+    # python numbers, as numpy scalars don't raise and may round differently
+    if isinstance(a, numpy.generic):
+        a = a.item()
+    if isinstance(b, numpy.generic):
+        b = b.item()
+    try:
+        value = a ** b
+    except (OverflowError, ZeroDivisionError):
+        return _ieee(numpy.float_power, a, b)
+    if isinstance(value, complex):  # a negative number to a fraction
+        return _ieee(numpy.float_power, a, b)
+    return value
+
+
+def exp(x):
+    """The exponential of x."""
+    if not isinstance(x, numpy.ndarray) and -708 < x < 709:
+        return numpy.exp(x)  # can't fail
+    return _ieee(numpy.exp, x)
+
+
+def log(x):
+    """The natural logarithm of x."""
+    if not isinstance(x, numpy.ndarray) and 0 < x < numpy.inf:
+        return numpy.log(x)  # can't fail
+    return _ieee(numpy.log, x)
+
+
+def sqrt(x):
+    """The square root of x."""
+    if not isinstance(x, numpy.ndarray) and x >= 0:
+        return numpy.sqrt(x)
+    return _ieee(numpy.sqrt, x)
+
+
+def clip(x, lower, upper):
+    """x, within lower and upper."""
+    if isinstance(x, numpy.ndarray):
+        return numpy.clip(x, lower, upper)
+    return lower if x < lower else upper if x > upper else x
+
+
+def where(condition, a, b):
+    """a where condition holds, b elsewhere (both are evaluated)."""
+    if isinstance(condition, numpy.ndarray):
+        return numpy.where(condition, a, b)
+    return a if condition else b
+
+
+maximum = numpy.maximum
+minimum = numpy.minimum
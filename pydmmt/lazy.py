@@ -0,0 +1,150 @@
+"""Demand driven evaluation of the targets of a model."""
+import numpy
+
+
+class LazyEvaluator():
+    """Evaluate only the cells transitively required by the targets.
+
+    A cell is a (name, index) couple: the value of an indexed variable at
+    that index, or the value of a non indexed function evaluated at that
+    step. Cells are computed at most once per evaluation, in the order given
+    by an explicit stack (no recursion limit on long timelines). The names in
+    invariant are non indexed and the same at every step: their cells have
+    None as index.
+    """
+
+    def __init__(self, functions, graph, inputs, first_step=0,
+                 invariant=()):
+        self.functions = functions
+        self.graph = graph
+        self.inputs = {v: v for v in inputs}
+        self.input_cells = [(v.name, int(v.index)) for v in inputs
+                            if v.is_absolutely_indexed]
+        self.first_step = first_step
+        self.invariant = set(invariant)
+
+    def evaluate(self, targets, input_data, sim_data=None, step=0, cells=(),
+                 sim_known=None):
+        """Values of the targets, non indexed ones evaluated at step.
+
+        Computed cells of indexed variables are also stored in sim_data, if
+        it has a field for them. Any further cell required (e.g. by the
+        logs) can be given in cells. sim_known are the masks of the values
+        given in sim_data: reading a gap of the external data is an error.
+        """
+        self.input_data = input_data
+        self.sim_data = sim_data
+        self.sim_known = sim_known
+        # the indexed inputs are known from the start
+        self.memo = {cell: sim_data[cell[0]][cell[1]]
+                     for cell in self.input_cells}
+        for cell in [self._target_cell(v, step) for v in targets]:
+            if cell is not None:
+                self._demand(cell)
+        for cell in cells:
+            try:
+                self._definition(cell)
+            except ValueError:
+                continue  # e.g. h[t+1] at the first index
+            self._demand(cell)
+        return [self._input_value(v, step) for v in targets]
+
+    def _target_cell(self, v, step):
+        if v in self.inputs or v.name not in self.graph.definitions:
+            return None
+        if v.is_absolutely_indexed and not v.is_sliced:
+            return (v.name, int(v.index))
+        if v.name in self.invariant:
+            return (v.name, None)
+        return (v.name, step)
+
+    def _definition(self, cell):
+        # the output and the step a cell is evaluated with
+        name, index = cell
+        candidates = self.graph.definitions.get(name, [])
+        for output in candidates:
+            if not output.is_indexed:
+                return output, index
+            if output.is_absolutely_indexed and int(output.index) == index:
+                return output, index
+        for output in candidates:
+            if (output.is_relatively_indexed and
+                    index - output.delay >= self.first_step):
+                return output, index - output.delay
+        raise ValueError("Variable", name + '[' + str(index) + ']',
+                         "is not evaluable.")
+
+    def _requirements(self, v, step):
+        # the cells v needs to be evaluated at step
+        if v in self.inputs or v.name not in self.graph.definitions:
+            return []
+        if not v.is_indexed:
+            return [(v.name, None if v.name in self.invariant else step)]
+        if v.is_relatively_indexed:
+            return [(v.name, step + v.delay)]
+        if not v.is_sliced:
+            return [(v.name, int(v.index))]
+        if v.slice.stop is None:
+            raise ValueError("Variable", v, "is open ended.")
+        return [(v.name, i) for i in range(v.slice.start or 0, v.slice.stop)]
+
+    def _demand(self, cell):
+        stack = [cell]
+        pending = set()
+        while stack:
+            cell = stack[-1]
+            if cell in self.memo:
+                stack.pop()
+                continue
+            output, step = self._definition(cell)
+            function = self.functions[output]
+            missing = [c for v in function.inputs
+                       for c in self._requirements(v, step)
+                       if c not in self.memo]
+            if missing:
+                if cell in pending:
+                    raise ValueError("Algebraic loop found evaluating",
+                                     cell)
+                pending.add(cell)
+                stack += missing
+                continue
+            stack.pop()
+            pending.discard(cell)
+            for v in function.inputs:
+                v.value = self._input_value(v, step)
+            self._store(cell, function.calculate(), output)
+
+    def _store(self, cell, value, output):
+        if (self.sim_data is not None and output.is_indexed and
+                cell[0] in self.sim_data.dtype.names):
+            self.sim_data[cell[0]][cell[1]] = value
+            value = self.sim_data[cell[0]][cell[1]]
+        self.memo[cell] = value
+
+    def _input_value(self, v, step):
+        if v in self.inputs:
+            if v.is_indexed:
+                return self.sim_data[v.name][int(v.index)]
+            return self.input_data[v]
+        if v.name not in self.graph.definitions:
+            if v.name == 't':
+                return step
+            return self._external(v, step)
+        if v.is_sliced:
+            return numpy.array([self.memo[c]
+                                for c in self._requirements(v, step)])
+        return self.memo[self._requirements(v, step)[0]]
+
+    def _external(self, v, step):
+        # external data, as loaded in sim_data
+        if v.is_relatively_indexed:
+            idx = step + v.delay
+        elif v.is_sliced:
+            idx = v.slice
+        else:
+            idx = int(v.index)
+        if self.sim_known is not None and \
+                not numpy.all(self.sim_known[v.name][idx]):
+            raise ValueError("No value of", v, "at", idx,
+                             "in the external data")
+        return self.sim_data[v.name][idx]
@@ -0,0 +1,183 @@
+"""Closed form evaluation of linear time-invariant recurrences."""
+import numpy
+
+
+class LinearRecurrence():
+    """The block of functions of a model forming a linear recurrence.
+
+    A variable is part of the block if it has a single relative definition
+    which is an affine combination, with constant coefficients, of variables
+    of the block (e.g. "n1[t+1] = 1.6 * n2[t] + 1.2 * n3[t]"). The block is
+    then rewritten as z[s] = M z[s-1] where z is the vector of the past values
+    each variable is needed on, augmented with a constant 1.
+    Variables whose past is not needed (e.g. "N[t+1] = n1[t+1] + n2[t+1]")
+    are outputs, read from z[s-1] with a row vector.
+    """
+
+    # the number of matrix powers computed at once
+    chunk = 4096
+
+    def __init__(self, graph, functions, ranges, bounds, pinned=(),
+                 vectors=()):
+        self.names = list()
+        self.states = list()
+        self.first = None
+        forms = self._affine_definitions(graph, functions, ranges, vectors)
+        resolved = self._resolve(forms)
+        if not resolved:
+            return
+        # all the indexes from first on are computed by the recurrence
+        first = max(bounds[0] + forms[x][0].delay for x in resolved)
+        if any(v.name in resolved and int(v.index) >= first
+               for v in pinned):
+            return
+
+        depth = dict()
+        for terms, _ in resolved.values():
+            for (x, lag) in terms:
+                depth[x] = max(depth.get(x, 0), lag)
+        if not depth:
+            return
+        self.names = graph.order(list(resolved))
+        self.states = [(x, j) for x in self.names if x in depth
+                       for j in range(depth[x])]
+        self.first = first
+        self.ranges = {x: (max(first, ranges[x][0]), ranges[x][1])
+                       for x in self.names}
+
+        size = len(self.states) + 1
+        position = {state: i for i, state in enumerate(self.states)}
+        self.matrix = numpy.zeros((size, size))
+        self.matrix[-1, -1] = 1
+        self.outputs = dict()
+        for x in self.names:
+            # x[s] as a function of z[s-1]
+            row = numpy.zeros(size)
+            for (y, lag), c in resolved[x][0].items():
+                row[position[(y, lag - 1)]] += c
+            row[-1] = resolved[x][1]
+            if x in depth:
+                self.matrix[position[(x, 0)]] = row
+                for j in range(1, depth[x]):
+                    self.matrix[position[(x, j)], position[(x, j - 1)]] = 1
+            else:
+                self.outputs[x] = row
+
+    @staticmethod
+    def _affine_definitions(graph, functions, ranges, vectors=()):
+        # name -> (output, {(name, lag): coefficient}, constant), for the
+        # scalar variables only
+        forms = dict()
+        for name in ranges:
+            if name in vectors:
+                continue
+            relatives = [v for v in graph.definitions[name]
+                         if v.is_relatively_indexed]
+            if len(relatives) != 1:
+                continue
+            output = relatives[0]
+            function = functions[output]
+            form = function.linear_form()
+            if form is None or not all(v.is_relatively_indexed and
+                                       not v.is_sliced
+                                       for v in function.inputs):
+                continue
+            terms = dict()
+            for position, c in form[0].items():
+                v = function.inputs[position]
+                key = (v.name, output.delay - v.delay)
+                terms[key] = terms.get(key, 0) + c
+            if any(lag < 0 for (_, lag) in terms):
+                continue
+            forms[name] = (output, terms, form[1])
+        # drop the ones relying on anything else, until nothing changes
+        changed = True
+        while changed:
+            changed = False
+            for name in list(forms):
+                if any(x not in forms for (x, _) in forms[name][1]):
+                    del forms[name]
+                    changed = True
+        return forms
+
+    @staticmethod
+    def _resolve(forms):
+        # substitute the same step references (lag 0), so that every name
+        # depends only on the past: name -> ({(name, lag >= 1): c}, constant)
+        resolved = dict()
+
+        def resolve(name, stack):
+            if name in resolved:
+                return resolved[name]
+            if name in stack:
+                raise ValueError(stack)
+            terms, constant = dict(), forms[name][2]
+            for (x, lag), c in forms[name][1].items():
+                if lag > 0:
+                    terms[(x, lag)] = terms.get((x, lag), 0) + c
+                    continue
+                sub_terms, sub_constant = resolve(x, stack + [name])
+                for key, sub_c in sub_terms.items():
+                    terms[key] = terms.get(key, 0) + c * sub_c
+                constant += c * sub_constant
+            resolved[name] = (terms, constant)
+            return resolved[name]
+
+        for name in forms:
+            try:
+                resolve(name, [])
+            except ValueError:
+                # algebraic loop: leave the block to the step by step engine
+                return dict()
+        return resolved
+
+    def evaluate(self, initial):
+        """Compute the block on the ranges it is needed on.
+
+        initial maps each state (name, j) with its value at index
+        self.first - 1 - j. Returns a dict mapping names with a tuple
+        (first index, numpy array of values).
+        """
+        # the z[s] needed, from lower to upper
+        lower = min(self.ranges[x][0] - (0 if x not in self.outputs else 1)
+                    for x in self.names)
+        upper = max(self.ranges[x][1] for x in self.names)
+        z = numpy.array([initial[state] for state in self.states] + [1.])
+        # jump to the first needed, by repeated squaring
+        z = numpy.linalg.matrix_power(self.matrix, lower - self.first + 1)\
+                        .dot(z)
+        count = upper - lower + 1
+        powers = self._powers(self.matrix, min(count, self.chunk))
+        trajectory = numpy.empty((count, len(z)), dtype=z.dtype)
+        for start in range(0, count, self.chunk):
+            stop = min(start + self.chunk, count)
+            trajectory[start:stop] = numpy.matmul(powers[:stop - start], z)
+            z = self.matrix.dot(trajectory[stop - 1])
+
+        results = dict()
+        for x in self.names:
+            first, last = self.ranges[x]
+            if first > last:
+                continue
+            if x in self.outputs:
+                z_s = trajectory[first - 1 - lower:last - lower]
+                results[x] = (first, z_s.dot(self.outputs[x]))
+            else:
+                column = self.states.index((x, 0))
+                results[x] = (first,
+                              trajectory[first - lower:last - lower + 1,
+                                         column])
+        return results
+
+    @staticmethod
+    def _powers(matrix, count):
+        # M^0, M^1, ... M^(count - 1), doubling the batch at each product
+        powers = numpy.empty((count, ) + matrix.shape)
+        powers[0] = numpy.eye(len(matrix))
+        done, step = 1, matrix
+        while done < count:
+            todo = min(done, count - done)
+            powers[done:done + todo] = numpy.matmul(powers[:todo], step)
+            done += todo
+            step = step.dot(step)
+        return powers
@@ -0,0 +1,160 @@
+"""Log files of the simulations, one per evaluation or packed in one file.
+
+Each file in the "logging" section gets the logged variables at each step of
+the timeline. By default every evaluation writes a new file, numbered after
+the ones already there: simulation.log, simulation_1.log, simulation_2.log,
+... The directory is listed once, by the first evaluation of the model: the
+next numbers are kept in memory. The field "logs" within "simulation"
+changes how files are named:
+
+    run: a subdirectory for the files of this model, e.g. "worker_3"; with
+        "auto" a new run_N, next to the first log file
+    shard: files per subdirectory, numbered as the evaluations they hold
+        (e.g. with 1000, simulation_1234.log is in 1/)
+    pack: true to append all the evaluations to a single file, with the
+        number of the evaluation as first column
+"""
+import csv
+import os
+import re
+
+
+class Logs():
+    """Write the log files of a model, an evaluation at a time.
+
+    files maps each path to its logged variables.
+    """
+
+    def __init__(self, files, run=None, shard=None, pack=False):
+        self.files = files
+        self.run = run
+        self.shard = int(shard) if shard else None
+        self.pack = bool(pack)
+        # what's found on disk, the first time it's needed: the next number
+        # of each path, the directories made and the run directory
+        self._next = dict()
+        self._directories = set()
+        self._run = None
+
+    def write(self, timeline, data):
+        """Write the logged variables, found in data, along the timeline."""
+        for log, items in self.files.items():
+            path = self._place(log)
+            if self.pack:
+                self._append(path, timeline, data, items)
+                continue
+            while True:
+                name = self._name(path)
+                try:
+                    with open(name, "x", newline='') as f:
+                        _write(csv.writer(f), timeline, data, items)
+                    break
+                except FileExistsError:
+                    pass  # written by someone else meanwhile: the next one
+
+    def _place(self, log):
+        # the path of log within the run directory, if any
+        if self.run is None:
+            return log
+        if self._run is None:
+            self._run = self.run
+            if self.run == "auto":
+                self._run = _claim(os.path.dirname(log))
+        return os.path.join(os.path.dirname(log), self._run,
+                            os.path.basename(log))
+
+    def _name(self, path):
+        # the name of the next evaluation logged to path
+        if path not in self._next:
+            self._next[path] = self._scan(path)
+        number = self._next[path]
+        self._next[path] += 1
+        root, ext = os.path.splitext(path)
+        name = root + "_" + str(number) + ext if number else path
+        if self.shard:
+            name = os.path.join(os.path.dirname(root),
+                                str(number // self.shard),
+                                os.path.basename(name))
+        self._directory(os.path.dirname(name))
+        return name
+
+    def _scan(self, path):
+        # the number of the first evaluation not logged yet to path
+        directory, base = os.path.split(path)
+        root, ext = os.path.splitext(base)
+        directory = directory or '.'
+        if self.shard:
+            # only the last shard has room
+            shards = _numbers(directory, "", "")
+            if not shards:
+                return 0
+            directory = os.path.join(directory, str(max(shards)))
+        return max(_numbers(directory, root, ext), default=-1) + 1
+
+    def _append(self, path, timeline, data, items):
+        if path not in self._next:
+            self._next[path] = _last_evaluation(path) + 1
+        number = self._next[path]
+        self._next[path] += 1
+        self._directory(os.path.dirname(path))
+        with open(path, "a", newline='') as f:
+            logger = csv.writer(f)
+            if f.tell() == 0:
+                logger.writerow(['# evaluation', 't'] + items)
+            _write(logger, timeline, data, items, [number])
+
+    def _directory(self, directory):
+        if directory and directory not in self._directories:
+            os.makedirs(directory, exist_ok=True)
+            self._directories.add(directory)
+
+
+def _write(logger, timeline, data, items, first=None):
+    if first is None:
+        logger.writerow(['# t'] + items)
+        first = []
+    for t in timeline:
+        logger.writerow(first + [t] + [data[d.name][t] for d in items])
+
+
+def _claim(directory):
+    # the name of a new run_N directory within directory, made by this call
+    number = max(_numbers(directory or '.', "run", ""), default=0) + 1
+    while True:
+        name = "run_" + str(number)
+        try:
+            os.makedirs(os.path.join(directory, name))
+            return name
+        except FileExistsError:
+            number += 1  # made by someone else meanwhile
+
+
+def _numbers(directory, root, ext):
+    # the numbers of the files in directory named root_N.ext (root.ext is
+    # 0), or named N with no root
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    if not root:
+        return [int(name) for name in names if name.isdigit()]
+    pattern = re.compile(re.escape(root) + r"(?:_(\d+))?" + re.escape(ext) +
+                         "$")
+    found = [pattern.match(name) for name in names]
+    return [int(m.group(1) or 0) for m in found if m]
+
+
+def _last_evaluation(path):
+    # the number of the last evaluation packed in path, -1 if none
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 65536))
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return -1
+    for line in reversed(lines):
+        first = line.split(b',', 1)[0]
+        if first.strip().isdigit():
+            return int(first)
+    return -1
@@ -0,0 +1,257 @@
+"""Memory profile of a model: where the bytes go while it's built and run.
+
+    pydmmt.py model.yml --memory report.txt < inputs.txt
+
+or, from python, profile(sources, lines). Allocations are traced with
+tracemalloc, which slows everything down: the report is meant to size jobs
+and compare changes, not to be on in production. It lists:
+
+  * for each phase (build, external data, inputs, simulation, logs) the
+    time, the peak of the bytes allocated within the phase and the bytes
+    still held at its end, and the peak resident memory of the process;
+  * the bytes held by each variable of sim_data, its mask and snapshots;
+  * for each step of the simulation, the bytes and blocks (all of them,
+    and NumPy arrays) allocated within it and still held at its end, and
+    the peak of the bytes allocated within it and alive at the same time;
+    the temporaries freed within a step show in that peak only, they
+    aren't counted one by one;
+  * for each function, the calls, time, and what its values are (python
+    numbers, NumPy scalars or arrays), plus the bytes held at the end of
+    the steps that were allocated by its code.
+
+Held bytes are counted per phase and per step as allocated and not freed
+within it, so they are an upper bound of what a phase leaves behind.
+"""
+from collections import OrderedDict
+import numpy
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # not on windows
+    resource = None
+
+# the file name of the code compiled from the functions (see util.py)
+_FUNCTION_FILE = "<util.py: compiling function "
+
+
+class _Meter():
+    # traced memory over a phase, split in segments (e.g. the steps, or the
+    # phases within it): the traces are cleared at each mark, so that each
+    # segment has its own peak
+    running = list()
+
+    def __init__(self):
+        if _Meter.running:
+            _Meter.running[-1].mark()
+        _Meter.running.append(self)
+        tracemalloc.clear_traces()
+        self.held = 0
+        self.peak = 0
+
+    def mark(self, traced=None):
+        # traced, if given, is what was measured before the allocations of
+        # the measure itself
+        current, peak = traced or tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, self.held + peak)
+        self.held += current
+        tracemalloc.clear_traces()
+        return current, peak
+
+    def stop(self):
+        self.mark()
+        _Meter.running.pop()
+        if _Meter.running:
+            parent = _Meter.running[-1]
+            parent.peak = max(parent.peak, parent.held + self.peak)
+            parent.held += self.held
+
+
+class Report():
+    """What profile measured, printed as text tables by str."""
+
+    def __init__(self):
+        # phase -> [calls, seconds, peak bytes, held bytes, peak rss]
+        self.phases = OrderedDict()
+        # name -> bytes of sim_data (and masks)
+        self.variables = OrderedDict()
+        self.snapshots = 0
+        # each step: (held bytes, peak of the live bytes, held blocks,
+        # held arrays)
+        self.steps = list()
+        # function -> [calls, seconds, python, numpy scalars, arrays, held]
+        self.functions = OrderedDict()
+
+    def _phase(self, name, seconds, peak, held):
+        item = self.phases.setdefault(name, [0, 0., 0, 0, 0])
+        item[0] += 1
+        item[1] += seconds
+        item[2] = max(item[2], peak)
+        item[3] += held
+        item[4] = _peak_rss()
+
+    def __str__(self):
+        lines = ["Phases", _row("phase", "calls", "seconds", "peak bytes",
+                                "held bytes", "peak rss")]
+        for name, (calls, seconds, peak, held, rss) in self.phases.items():
+            lines.append(_row(name, calls, "%.4f" % seconds, peak, held,
+                              rss if rss is not None else "-"))
+        lines += ["", "State", _row("variable", "bytes")]
+        for name, size in self.variables.items():
+            lines.append(_row(name, size))
+        lines.append(_row("(snapshots)", self.snapshots))
+        lines.append(_row("(total)", sum(self.variables.values()) +
+                          self.snapshots))
+        if self.steps:
+            steps = numpy.array(self.steps, dtype=float)
+            lines += ["", "Steps (" + str(len(steps)) + ")",
+                      _row("per step", "held bytes", "peak live",
+                           "held blocks", "held arrays")]
+            for label, values in (("mean", steps.mean(axis=0)),
+                                  ("max", steps.max(axis=0))):
+                lines.append(_row(label, *["%.1f" % v for v in values]))
+        lines += ["", "Functions",
+                  _row("function", "calls", "seconds", "python", "numpy",
+                       "arrays", "held bytes")]
+        for name, (calls, seconds, python, scalars, arrays, held) in \
+                sorted(self.functions.items(), key=lambda i: -i[1][1]):
+            lines.append(_row(name, calls, "%.4f" % seconds, python,
+                              scalars, arrays, held))
+        return "\n".join(lines) + "\n"
+
+
+def _row(first, *others):
+    return "{:<40}".format(str(first)[:39]) + \
+        "".join("{:>14}".format(str(el)) for el in others)
+
+
+def _peak_rss():
+    # in bytes (linux gives kilobytes, macos bytes)
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _timed(report, phase, method):
+    # method, measured as a phase of the report
+    def wrapper(*args, **kwargs):
+        meter = _Meter()
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            meter.stop()
+            report._phase(phase, seconds, meter.peak, meter.held)
+    return wrapper
+
+
+def _instrument(report, model):
+    # wrap the methods of the model (and its functions) that make the phases
+    run_step = model._run_step
+
+    def step(step_ranges):
+        if not _Meter.running:
+            return run_step(step_ranges)
+        meter = _Meter.running[-1]
+        meter.mark()
+        try:
+            return run_step(step_ranges)
+        finally:
+            _measure_step(report, meter)
+
+    model._set_inputs = _timed(report, "inputs", model._set_inputs)
+    model.print_logs = _timed(report, "logs", model.print_logs)
+    model.run_simulation = _timed(report, "simulation", model.run_simulation)
+    model._evaluate_lazily = _timed(report, "simulation",
+                                    model._evaluate_lazily)
+    model._run_step = step
+    # a thread at a time: the steps are measured one after the other
+    model.threads = 1
+    for function in {id(f): f for f in model.functions.values()}.values():
+        function.calculate = _counted(report, function)
+
+
+def _measure_step(report, meter):
+    traced = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    arrays = snapshot.filter_traces(
+        [tracemalloc.DomainFilter(True, numpy.lib.tracemalloc_domain)])
+    for stat in snapshot.statistics("filename"):
+        filename = stat.traceback[0].filename
+        if filename.startswith(_FUNCTION_FILE):
+            name = filename[len(_FUNCTION_FILE):-1]
+            report.functions.setdefault(name, [0, 0., 0, 0, 0, 0])[5] += \
+                stat.size
+    report.steps.append(traced + (len(snapshot.traces), len(arrays.traces)))
+    del snapshot, arrays
+    meter.mark(traced)
+
+
+def _counted(report, function):
+    calculate = function.calculate
+    item = report.functions.setdefault(function.original_string,
+                                       [0, 0., 0, 0, 0, 0])
+
+    def wrapper():
+        start = time.perf_counter()
+        value = calculate()
+        item[1] += time.perf_counter() - start
+        item[0] += 1
+        if isinstance(value, numpy.ndarray):
+            item[4] += 1
+        elif isinstance(value, numpy.generic):
+            item[3] += 1
+        else:
+            item[2] += 1
+        return value
+    return wrapper
+
+
+def _state(report, model):
+    if not model.sim_timeline:
+        return
+    for name in model.sim_data.dtype.names:
+        size = model.sim_data[name].nbytes
+        if name in model.sim_known:
+            size += model.sim_known[name].nbytes
+        report.variables[name] = size
+    report.snapshots = sum(
+        s.sim_data.nbytes + sum(k.nbytes for k in s.sim_known.values())
+        for s in model.snapshots.values())
+
+
+def profile(sources, lines=(), output=None, model_class=None):
+    """Build the model in sources and evaluate it on each line of inputs,
+    measuring memory. Results are written to output, if given.
+
+    Returns the Report and the model, whose phases are measured by later
+    evaluations too (while tracemalloc is tracing). model_class is
+    pydmmt.Model, unless given.
+    """
+    if model_class is None:
+        from .pydmmt import Model as model_class
+    report = Report()
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    load_source = model_class._load_source
+    model_class._load_source = _timed(report, "external data", load_source)
+    try:
+        model = _timed(report, "build", model_class)(
+            {"sources": list(sources)})
+        model_class._load_source = load_source
+        _instrument(report, model)
+        for line in lines:
+            result = model.process_input(line)
+            if output is not None:
+                print(result, file=output)
+        _state(report, model)
+    finally:
+        model_class._load_source = load_source
+        if not tracing:
+            tracemalloc.stop()
+    return report, model
@@ -0,0 +1,184 @@
+"""Continuous time dynamics: states integrated between decision steps.
+
+    derivatives:
+      - "h' = a[t+1] - max(max(h - 100, 0), min(h, u[t]))"
+
+declares the state h, whose value after a step is its value before it plus
+the integral of its derivative over the step (a unit of time): the model
+gets h[t+1] from h[t] as from a function "h[t+1] = h[t] + ...". Within the
+derivatives the names of the states, not indexed, are their values along
+the step; anything else (e.g. the decision u[t] or the inflow a[t+1]) is
+held through the step.
+
+The integration is adaptive: an embedded Runge-Kutta pair (Dormand-Prince
+5(4)) takes long steps where the states change smoothly and short ones where
+they don't, keeping the local error within the field "tolerance" of
+"simulation" (relative, and absolute for states near zero). Only the values
+at the steps of the timeline are stored. An error that isn't finite (e.g.
+with nan inputs) gives nan states.
+"""
+import math
+import numbers
+# local import
+from . import util as ut
+
+# Dormand-Prince 5(4): stages, the 5th order solution and its error with
+# respect to the embedded 4th order one (the derivatives don't depend on the
+# time within the step, so the nodes aren't needed)
+_A = ((),
+      (1 / 5, ),
+      (3 / 40, 9 / 40),
+      (44 / 45, -56 / 15, 32 / 9),
+      (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+      (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+      (35 / 384, 0., 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84))
+_B = _A[6]
+_E = (71 / 57600, 0., -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525,
+      -1 / 40)
+# the smallest step, as a fraction of the decision step: below it the error
+# is accepted as it is, as long as it's finite
+_SMALLEST = 1e-10
+
+
+class System():
+    """The derivatives of some states, integrated together over a step.
+
+    texts are the derivatives, as "h' = expression"; each state gets an
+    Integral, the function of the model giving its value after a step.
+    """
+
+    def __init__(self, texts, constants=(), tolerance=1e-6):
+        self.tolerance = tolerance
+        self.states = list()
+        self.derivatives = list()
+        for text in texts:
+            state = text.split('=', maxsplit=1)[0].strip()
+            if not state.endswith("'") or \
+                    not ut.Variable.is_it(state[:-1].strip()) or \
+                    ut.Variable(state[:-1].strip()).is_indexed:
+                raise ut.YAMLError("Expected a derivative as \"h' = ...\","
+                                   " not " + text)
+            self.states.append(state[:-1].strip())
+            self.derivatives.append(ut.Function(text, constants))
+        if len(set(self.states)) < len(self.states):
+            raise ut.YAMLError("More than a derivative for a state in " +
+                               str(texts))
+        # what the derivatives read: the states, then what's held
+        self.held = list()
+        self._links = list()
+        for function in self.derivatives:
+            links = list()
+            for v in function.inputs:
+                if not v.is_indexed and v.name in self.states:
+                    links.append((v, self.states.index(v.name)))
+                    continue
+                if v not in self.held:
+                    self.held.append(v)
+                links.append((v, len(self.states) + self.held.index(v)))
+            self._links.append(links)
+        self.integrals = [Integral(self, position)
+                          for position in range(len(self.states))]
+        # evaluations of the derivatives, for all the steps so far
+        self.evaluations = 0
+        # the size of the last step taken, a guess for the next one
+        self._step = 1.
+        # the last integration, as (values, states at the end)
+        self._last = (None, None)
+
+    def solve(self, values):
+        """The states at the end of a step, from values of the states at
+        its beginning and of the held variables (the inputs of the
+        integrals)."""
+        last, states = self._last
+        if last is not None and len(last) == len(values) and \
+                all(a is b or isinstance(a, numbers.Real) and
+                    type(a) is type(b) and a == b
+                    for a, b in zip(last, values)):
+            return states  # the other states of the same step
+        states = self._integrate(list(values[:len(self.states)]),
+                                 list(values[len(self.states):]))
+        self._last = (list(values), states)
+        return states
+
+    def _slopes(self, states, held):
+        self.evaluations += 1
+        values = states + held
+        slopes = list()
+        for function, links in zip(self.derivatives, self._links):
+            for v, position in links:
+                v.value = values[position]
+            slopes.append(function.calculate())
+        return slopes
+
+    def _integrate(self, states, held):
+        time = 0.
+        step = self._step
+        k = [self._slopes(states, held)]
+        while time < 1.:
+            size = min(step, 1. - time)
+            for a in _A[1:6]:
+                k.append(self._slopes(
+                    [y + size * sum(c * s[i] for c, s in zip(a, k))
+                     for i, y in enumerate(states)], held))
+            new = [y + size * sum(c * s[i] for c, s in zip(_B, k) if c)
+                   for i, y in enumerate(states)]
+            k.append(self._slopes(new, held))
+            error = self._error(states, new,
+                                [size * sum(c * s[i] for c, s in zip(_E, k)
+                                            if c)
+                                 for i in range(len(states))])
+            if not math.isfinite(error):
+                # no step is small enough (e.g. nan given by the inputs)
+                states = [math.nan] * len(states)
+                break
+            accepted = error <= 1. or size <= _SMALLEST
+            if accepted:
+                time = 1. if size >= 1. - time else time + size
+                states = new
+            # the last stage is the first of the next step
+            k = k[-1:] if accepted else k[:1]
+            if error == 0.:
+                factor = 5.
+            elif error <= 1.:
+                factor = min(5., max(0.2, 0.9 * error ** -0.2))
+            else:
+                factor = 0.2
+            if not accepted or size == step:
+                step = max(size * factor, _SMALLEST)
+            else:  # cut short by the end of the step
+                step = max(step, size * factor)
+        self._step = step
+        return states
+
+    def _error(self, states, new, errors):
+        # root mean square of the errors, scaled by the tolerance
+        total = 0.
+        for y, z, e in zip(states, new, errors):
+            scale = self.tolerance * (1. + max(abs(float(y)),
+                                               abs(float(z))))
+            scaled = float(e) / scale
+            total += scaled * scaled
+        return math.sqrt(total / len(errors))
+
+
+class Integral(ut.TextBased):
+    """The value of a state after a step, as a function of the model: its
+    inputs are the states before the step and the held variables."""
+
+    def __init__(self, system, position):
+        self.system = system
+        self.position = position
+        self.original_string = system.derivatives[position].original_string
+        self.outputs = [ut.Variable(system.states[position] + "[t+1]")]
+        self.inputs = [ut.Variable(name + "[t]") for name in system.states] + \
+            [ut.Variable(v.original_string) for v in system.held]
+
+    def calculate(self):
+        return self.system.solve([v.value for v in self.inputs])[
+            self.position]
+
+    def constant(self):
+        return None
+
+    def linear_form(self):
+        return None
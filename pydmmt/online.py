@@ -0,0 +1,200 @@
+"""Online simulation of a model, driven by a stream of external data."""
+import csv
+# local import
+from .lazy import LazyEvaluator
+from . import util as ut
+
+
+class Waiting(Exception):
+    """Raised when a step needs external data that hasn't arrived yet."""
+    pass
+
+
+class OnlineSimulation(LazyEvaluator):
+    """Advance a model a step at a time, as its external data arrives.
+
+    Rows of external data are pushed one at a time; each step is evaluated
+    as soon as the data it reads is there, and the values of the outputs at
+    that step are returned, followed by the ones of the targets (nan until
+    they can be evaluated). Targets reading slices of the timeline (e.g. a
+    mean over it) are left out. Cells are kept only as long as the lags of
+    the functions can read them, so the memory used doesn't grow with time,
+    but the absolutely indexed ones (e.g. x[0]), kept for good.
+    """
+
+    def __init__(self, model, outputs=None):
+        LazyEvaluator.__init__(self, model.functions, model.graph,
+                               model.parameters["simulation"]["inputs"],
+                               model.sim_timeline[0]
+                               if model.sim_timeline else 0)
+        self.input_data = model.input_data
+        self.sim_data = None
+        if outputs is None:
+            outputs = list()
+            for items in model.parameters.get("logging", dict()).values():
+                outputs += [v for v in items if v not in outputs]
+        if not outputs:
+            outputs = [ut.Variable(name + "[t]") for name in
+                       sorted(self.graph.definitions)
+                       if any(v.is_relatively_indexed
+                              for v in self.graph.definitions[name])]
+        self.outputs = [ut.Variable(v) if isinstance(v, str) else v
+                        for v in outputs]
+        if any(v.is_absolutely_indexed for v in self.outputs):
+            raise ValueError("Only relatively indexed outputs are allowed")
+        self.targets = [v for v in model.parameters["simulation"]["target"]
+                        if not self._reads_slices(v)]
+
+        # what is evaluated at each step
+        self.todo = list()
+        for name in self.graph.order(self.graph.required(
+                [v.name for v in self.outputs + self.targets])):
+            for output in self.graph.definitions[name]:
+                if any(v.is_sliced for v in self.functions[output].inputs):
+                    raise ValueError("Variable", output, "reads a slice of"
+                                     " the timeline: can't run online.")
+                if not output.is_absolutely_indexed:
+                    self.todo.append(output)
+        # how far in the past the step can read
+        delays = [v.delay for output in self.todo
+                  for v in [output] + self.functions[output].inputs
+                  if v.is_relatively_indexed]
+        delays += [v.delay for v in self.outputs if v.is_relatively_indexed]
+        self.depth = -min(delays + [0])
+        # the cells read at an absolute index, never dropped
+        self.pinned = {(v.name, int(v.index)) for output in self.todo
+                       for v in self.functions[output].inputs
+                       if v.is_absolutely_indexed}
+        self.pinned |= {(v.name, int(v.index)) for v in self.targets
+                        if v.is_absolutely_indexed}
+
+        self.reset()
+
+    def reset(self):
+        """Restart from the first step, e.g. after a change of the inputs."""
+        # the indexed inputs are known from the start, and never dropped
+        self.memo = {(v.name, int(v.index)): self.input_data[v]
+                     for v in self.inputs if v.is_absolutely_indexed}
+        self.buckets = dict()  # maps an index with the cells stored there
+        self.step = self.first_step
+        self.last_row = None
+
+    def push(self, row):
+        """Add a row of external data, a mapping with the 't' item.
+
+        Returns the list of (step, values of the outputs) of the steps that
+        can be evaluated now, possibly empty.
+        """
+        t = int(float(row["t"]))
+        for name, value in row.items():
+            # the model's own variables are computed, not read
+            if name != "t" and name not in self.graph.definitions:
+                self._remember((name, t), float(value))
+        self.last_row = t if self.last_row is None else max(self.last_row, t)
+        results = list()
+        while self.step <= self.last_row:
+            try:
+                values = self._run_step(self.step)
+            except Waiting:
+                break
+            results.append((self.step, values))
+            self._forget(self.step + 1 - self.depth)
+            self.step += 1
+        return results
+
+    def _run_step(self, step):
+        for output in self.todo:
+            if output.is_relatively_indexed:
+                cell = (output.name, step + output.delay)
+            else:
+                cell = (output.name, step)
+            try:
+                self._demand(cell)
+            except ValueError:
+                # e.g. h[t+1] or day[t-1] before the first step: left out,
+                # as it would be nan in sim_data
+                continue
+        values = list()
+        for v in self.outputs:
+            index = step + (v.delay if v.is_relatively_indexed else 0)
+            values.append(self.memo.get((v.name, index), float("nan")))
+        return values + [self._target(v, step) for v in self.targets]
+
+    def _target(self, v, step):
+        # the value of a target, if it can be evaluated at step
+        cell = self._target_cell(v, step)
+        try:
+            if cell is None:  # an input or external data
+                return self._input_value(v, step)
+            if cell not in self.memo and self._definition(cell)[1] <= step:
+                self._demand(cell)
+        except (Waiting, ValueError):
+            pass
+        return self.memo.get(cell, float("nan"))
+
+    def _reads_slices(self, v):
+        # whether v, or what it needs, reads a slice of the timeline
+        return v.is_sliced or any(
+            u.is_sliced for name in self.graph.required([v.name])
+            for output in self.graph.definitions[name]
+            for u in self.functions[output].inputs)
+
+    def _store(self, cell, value, output):
+        # as if stored in sim_data
+        self._remember(cell, float(value))
+
+    def _remember(self, cell, value):
+        self.memo[cell] = value
+        if cell not in self.pinned:
+            self.buckets.setdefault(cell[1], []).append(cell)
+
+    def _forget(self, index):
+        # drop every cell stored before index
+        for old in [i for i in self.buckets if i < index]:
+            for cell in self.buckets.pop(old):
+                self.memo.pop(cell, None)
+
+    def _input_value(self, v, step):
+        if v in self.inputs:
+            return self.input_data[v]
+        return LazyEvaluator._input_value(self, v, step)
+
+    def _external(self, v, step):
+        cell = (v.name, step + v.delay if v.is_relatively_indexed
+                else int(v.index))
+        if cell not in self.memo:
+            raise Waiting(cell)
+        return self.memo[cell]
+
+
+def run(model, instream, outstream, outputs=None):
+    """Simulate the model online, reading external data from a csv stream.
+
+    The stream has the same format of the external csv files ("# t,..." on
+    the first line); a line with the values of the outputs and of the
+    targets is written, and flushed, as soon as a step is evaluated. Empty
+    lines are skipped, lines with more or less values than the header are
+    errors.
+    """
+    simulation = OnlineSimulation(model, outputs)
+    reader = csv.reader(instream)
+    headers = next(reader, None)
+    if not headers or not headers[0] or headers[0][0] != '#':
+        raise ValueError("Can't find the header of the stream")
+    headers[0] = headers[0][1:].strip()
+    if "t" not in headers:
+        raise ValueError("Can't find the 't' column in the stream")
+    writer = csv.writer(outstream)
+    writer.writerow(['# t'] + simulation.outputs + simulation.targets)
+    outstream.flush()
+    for row in reader:
+        if not row:
+            continue
+        if len(row) != len(headers):
+            raise ValueError("Line " + str(reader.line_num) + " of the stream"
+                             " has " + str(len(row)) + " values, not " +
+                             str(len(headers)))
+        for step, values in simulation.push(dict(zip(headers, row))):
+            writer.writerow([step] + values)
+        outstream.flush()
+    return simulation
@@ -0,0 +1,72 @@
+"""Binary protocol to exchange inputs and targets with a model.
+
+Vectors are sequences of little-endian float64. In the "framed" layout each
+vector is preceded by its length as a little-endian uint32; in the "fixed"
+layout there's no header, and the vector length is agreed beforehand from
+the inputs and targets in the YAML.
+"""
+import numpy
+import struct
+
+HEADER = struct.Struct('<I')
+VALUE = numpy.dtype('<f8')
+
+
+def read_frame(stream, size=None):
+    """Read a vector from stream, None if the stream is over.
+
+    If size is given, the vector has no header and is size values long.
+    """
+    if size is None:
+        header = _read_exactly(stream, HEADER.size)
+        if header is None:
+            return None
+        size = HEADER.unpack(header)[0]
+        if size == 0:
+            return numpy.empty(0, dtype=VALUE)
+    payload = _read_exactly(stream, size * VALUE.itemsize)
+    if payload is None:
+        return None
+    return numpy.frombuffer(payload, dtype=VALUE)
+
+
+def write_frame(stream, values, header=True):
+    """Write a vector to stream, preceded by its length if header."""
+    values = numpy.asarray(values, dtype=VALUE)
+    if header:
+        stream.write(HEADER.pack(len(values)))
+    stream.write(values.tobytes())
+
+
+def serve(model, instream, outstream, layout="framed"):
+    """Evaluate model on each vector read from instream, until it's over.
+
+    Targets are written to outstream with the same layout.
+    """
+    framed = layout == "framed"
+    size = None if framed else model.input_size
+    if size == 0:
+        raise ValueError("A model without inputs needs the framed layout")
+    while True:
+        values = read_frame(instream, size)
+        if values is None:
+            return
+        write_frame(outstream, model.process_values(values), framed)
+        outstream.flush()
+
+
+def _read_exactly(stream, size):
+    # None at the end of the stream, a frame cut in half is an error
+    chunks = list()
+    missing = size
+    while missing > 0:
+        chunk = stream.read(missing)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        missing -= len(chunk)
+    if missing == size:
+        return None
+    if missing > 0:
+        raise EOFError("Truncated frame: " + str(missing) + " bytes missing")
+    return b''.join(chunks)
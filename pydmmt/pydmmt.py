@@ -1,16 +1,36 @@
 #!/usr/bin/env python3
 """pydmmt performs numerical simulations of dynamic systems."""
 
-from collections import OrderedDict
-import csv
-import glob
+from collections import namedtuple, OrderedDict
 import itertools
 import math
 import numpy
 import os
 import sys
+import time
+
+if __name__ == "__main__" and not __package__:
+    # run as a script (pydmmt/pydmmt.py): a module of the package all the
+    # same (PEP 366), found from the directory holding it
+    sys.path[0] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    __package__ = "pydmmt"
+
 # local import
-import util as ut
+from .graph import DependencyGraph  # NOQA: E402
+from .lazy import LazyEvaluator  # NOQA: E402
+from .linear import LinearRecurrence  # NOQA: E402
+from . import kernels  # NOQA: E402
+from . import util as ut  # NOQA: E402
+# imported when needed, as they're optional: concurrent.futures (threads),
+# csv (external data), yaml, ode (derivatives), logs, template, artifact,
+# memory, online, protocol and table; numpy isn't, as util and kernels, that
+# any model is built with, need it
+
+
+# the state of a simulation at the beginning of a step: what's needed to
+# resume it from there
+Snapshot = namedtuple("Snapshot",
+                      ["step", "sim_data", "sim_known", "step_ranges"])
 
 
 class Model:
@@ -19,30 +39,72 @@ class Model:
         if not params:
             raise ValueError("No parameters given to Model constructor")
 
+        # a compiled model (see save), restored as it was built
+        if (params["sources"] and len(params["sources"]) == 1 and
+                os.path.splitext(params["sources"][0])[1] == ".pdm"):
+            self.__dict__.update(Model.load(params["sources"][0]).__dict__)
+            return
+
         if params["sources"]:
             import yaml
+            # safe loading, with the C implementation if available
+            loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
             data_cache = []
             for src in params["sources"]:
                 with open(src, 'r') as f:
-                    data_cache.append(yaml.load(f))
+                    data_cache.append(yaml.load(f, Loader=loader))
             params["sources"] = data_cache
 
         self.parameters = dict()
         self.parameters["simulation"] = dict()
         self.parameters["simulation"]["target"] = list()
         self.parameters["simulation"]["inputs"] = list()
+        self.parameters["simulation"]["evaluation"] = "auto"
+        self.parameters["simulation"]["checkpoints"] = list()
+        self.parameters["simulation"]["threads"] = 1
+        self.parameters["simulation"]["dtype"] = "float"
+        self.parameters["simulation"]["dtypes"] = dict()
+        self.parameters["simulation"]["lengths"] = dict()
+        self.parameters["simulation"]["errors"] = "raise"
+        self.parameters["simulation"]["tolerance"] = 1e-6
+        self.parameters["simulation"]["logs"] = dict()
+        self.input_data = dict()
 
         self.variable_names = dict()  # maps deindexified name with indexed one
         self.functions = dict()
+        # named numbers and arrays, that any function can use
+        self.constants = dict()
+        for source in params["sources"]:
+            if "constants" in source and source["constants"]:
+                self.constants.update(
+                    {name: numpy.array(value, dtype=float)
+                     if isinstance(value, list) else value
+                     for name, value in source["constants"].items()})
+        templates = dict()
+        instances = dict()
+        derivatives = list()
+        self.gaps = dict()
         for source in params["sources"]:
             # check for field existence and emptiness
             if "functions" in source and source["functions"]:
                 for function in source["functions"]:
-                    item = ut.Function(function)
+                    item = ut.Function(function, self.constants)
                     self.functions.update({y: item for y in item.outputs})
                     self.variable_names.update({y: y.name for y
                                                 in item.inputs + item.outputs})
 
+            # states of continuous time dynamics, integrated along each step
+            if "derivatives" in source and source["derivatives"]:
+                derivatives += source["derivatives"]
+
+            # groups of functions to be instantiated, maybe by other sources
+            if "templates" in source and source["templates"]:
+                from .template import Template
+                for name, definition in source["templates"].items():
+                    templates[name] = Template(name, definition)
+            if "instances" in source and source["instances"]:
+                instances.update(source["instances"])
+
             # take care of simulation details
             if "simulation" in source and "target" in source["simulation"]:
                 items = [ut.Variable(item)
@@ -57,8 +119,62 @@ class Model:
                          if ut.Variable.is_it(item)]
                 assert not any(item.is_relatively_indexed for item in items)
                 self.parameters["simulation"]["inputs"] += items
-                self.input_data = {item: 0 for item in items
-                                   if not item.is_indexed}
+                self.input_data.update({item: 0 for item in items
+                                        if not item.is_indexed})
+
+            # steps at which the simulation is saved, to be resumed later
+            if "simulation" in source and \
+                    "checkpoints" in source["simulation"]:
+                self.parameters["simulation"]["checkpoints"] += \
+                    [int(k) for k in source["simulation"]["checkpoints"]]
+
+            # threads evaluating independent strands of a step
+            if "simulation" in source and "threads" in source["simulation"]:
+                self.parameters["simulation"]["threads"] = \
+                    int(source["simulation"]["threads"])
+
+            # storage type of sim_data, for all the variables or by name
+            if "simulation" in source and "dtype" in source["simulation"]:
+                self.parameters["simulation"]["dtype"] = \
+                    source["simulation"]["dtype"]
+            if "simulation" in source and "dtypes" in source["simulation"]:
+                self.parameters["simulation"]["dtypes"].update(
+                    source["simulation"]["dtypes"])
+
+            # vector valued variables, by name
+            if "simulation" in source and "lengths" in source["simulation"]:
+                self.parameters["simulation"]["lengths"].update(
+                    {name: int(n) for name, n
+                     in source["simulation"]["lengths"].items()})
+
+            # what floating point errors of the kernels give (see kernels.py)
+            if "simulation" in source and "errors" in source["simulation"]:
+                if source["simulation"]["errors"] not in kernels.POLICIES:
+                    raise ut.YAMLError("Unknown errors policy " +
+                                       str(source["simulation"]["errors"]))
+                self.parameters["simulation"]["errors"] = \
+                    source["simulation"]["errors"]
+
+            # local error of the integration of the derivatives (see ode.py)
+            if "simulation" in source and \
+                    "tolerance" in source["simulation"]:
+                self.parameters["simulation"]["tolerance"] = \
+                    float(source["simulation"]["tolerance"])
+
+            # naming of the log files (see logs.py)
+            if "simulation" in source and "logs" in source["simulation"]:
+                unknown = set(source["simulation"]["logs"]) - \
+                    {"run", "shard", "pack"}
+                if unknown:
+                    raise ut.YAMLError("Unknown logs fields " +
+                                       str(sorted(unknown)))
+                self.parameters["simulation"]["logs"].update(
+                    source["simulation"]["logs"])
+
+            # eager (step by step) or lazy (on demand) evaluation
+            if "simulation" in source and "evaluation" in source["simulation"]:
+                self.parameters["simulation"]["evaluation"] = \
+                    source["simulation"]["evaluation"]
 
             # check for any logging requirement
             if "logging" in source:
@@ -74,6 +190,10 @@ class Model:
                  if source["logging"][filename] and
                     len(source["logging"][filename]) > 0]
 
+            # how to fill the gaps of the external data (see gaps.py)
+            if "gaps" in source and source["gaps"]:
+                self.gaps.update(source["gaps"])
+
             # check for any external source
             if "external" in source:
                 # create space, if it's first external source found
@@ -82,32 +202,189 @@ class Model:
                 # then read each logfile to produce
                 self.parameters["external"] += source["external"]
 
+        # the integrals of the derivatives are functions of the model
+        self.system = None
+        if derivatives:
+            from .ode import System
+            self.system = System(derivatives, self.constants,
+                                 self.parameters["simulation"]["tolerance"])
+            for item in self.system.integrals:
+                self.functions.update({y: item for y in item.outputs})
+                self.variable_names.update({y: y.name for y
+                                            in item.inputs + item.outputs})
+
+        for name, instance in instances.items():
+            instance = instance or dict()
+            if instance.get("template") not in templates:
+                raise ut.YAMLError("Unknown template for instance " + name)
+            items = templates[instance["template"]].instantiate(
+                instance.get("prefix", name + "_"),
+                instance.get("parameters"), instance.get("bindings"))
+            for item in items:
+                self.functions.update({y: item for y in item.outputs})
+                self.variable_names.update({y: y.name for y
+                                            in item.inputs + item.outputs})
+
         # consistency check
         if not self.parameters["simulation"]["target"]:
             raise ut.YAMLError("No target found in given YAML files")
+        # number of values in an input line
+        self.input_size = sum(getattr(v, "length", 1)
+                              for v in self.parameters["simulation"]["inputs"])
 
         # simulation function sequence and database, if needed
+        self.graph = DependencyGraph(self.functions)
+        # non indexed functions that don't change along the timeline are
+        # evaluated once per evaluation
+        self.time_invariant = self._time_invariant()
+        self.invariant_values = dict()
         self._build_timeline()
         if self.sim_timeline:  # if is an instance of a dynamic model
             self._build_simulation_helpers()
             helper = {h.name for h in self.sim_step_todo}
+            helper |= {v.name for v in self.parameters["simulation"]["inputs"]
+                       if v.is_indexed}
             if "logging" in self.parameters and self.parameters["logging"]:
                 for log_file in self.parameters["logging"]:
                     helper |= {h.name for h
                                in self.parameters["logging"][log_file]}
             sim_types = {'names': list(helper),
-                         'formats': ['float'] * len(helper)}
-            self.sim_data = numpy.full(len(self.sim_timeline), numpy.nan,
-                                       dtype=sim_types)
+                         'formats': [self._dtype_of(h) for h in helper]}
+            self.sim_data = numpy.zeros(len(self.sim_timeline),
+                                        dtype=sim_types)
+            # what's computed is told by a mask, for each field
+            self.sim_known = dict()
+            self._add_masks(helper)
 
         # load external source if any
         if "external" in self.parameters:
             for source in self.parameters["external"]:
                 if not self._load_source(source):
                     self.parameters["external"].remove(source)
+        if self.gaps:
+            self._fill_gaps()
+
+        self.evaluation = self._choose_evaluation(
+            self.parameters["simulation"]["evaluation"])
+        self.lazy = LazyEvaluator(
+            self.functions, self.graph,
+            self.parameters["simulation"]["inputs"],
+            self.sim_timeline[0] if self.sim_timeline else 0,
+            {v.name for v in self.time_invariant})
+
+        self._prepare_runs()
+
+    # what's set up by _prepare_runs, not saved in compiled models
+    runtime = ("errors", "threads", "_executor", "checkpoints", "snapshots",
+               "logs", "current_step", "time_origin")
+
+    def _prepare_runs(self):
+        # the floating point errors of the evaluations (see kernels.py)
+        self.errors = kernels.Errors(self.parameters["simulation"]["errors"])
+
+        # threads are worth only with more than a strand to run
+        self.threads = self.parameters["simulation"]["threads"]
+        self._executor = None
+
+        # snapshots of the simulation, by step
+        self.checkpoints = set(self.parameters["simulation"]["checkpoints"])
+        self.snapshots = dict()
+
+        # the log files, named once their directories are listed
+        self.logs = None
+        if "logging" in self.parameters:
+            from .logs import Logs
+            self.logs = Logs(self.parameters["logging"],
+                             **self.parameters["simulation"]["logs"])
 
         # last but not least, initialize internal clock
         self.current_step = 0
+        # the value of t at the first index of the timeline, less the index:
+        # moves the model along time (see horizon.py)
+        self.time_origin = 0
+
+    def _time_invariant(self):
+        # the non indexed outputs depending only on non indexed inputs
+        found = {v for v in self.parameters["simulation"]["inputs"]
+                 if not v.is_indexed}
+        candidates = [v for v in self.functions if not v.is_indexed and
+                      len(self.graph.definitions[v.name]) == 1]
+        changed = True
+        while changed:
+            changed = False
+            for v in candidates:
+                if v not in found and all(
+                        i in found for i in self.functions[v].inputs):
+                    found.add(v)
+                    changed = True
+        return {v for v in found if v in self.functions}
+
+    def _dtype_of(self, name):
+        dtype = self.parameters["simulation"]["dtypes"].get(
+            name, self.parameters["simulation"]["dtype"])
+        try:
+            dtype = numpy.dtype(dtype)
+        except TypeError:
+            raise ut.YAMLError("Unknown dtype " + str(dtype) + " for " + name)
+        if name in self.parameters["simulation"]["lengths"]:
+            return numpy.dtype(
+                (dtype, (self.parameters["simulation"]["lengths"][name], )))
+        return dtype
+
+    def _add_masks(self, names):
+        # what's computed (or given) is told by a mask, for every variable:
+        # nan is a value as any other, written where it fits as the logs
+        # show it
+        for name in names:
+            if self.sim_data.dtype[name].kind in "fc":
+                self.sim_data[name] = numpy.nan
+            self.sim_known[name] = numpy.zeros(len(self.sim_timeline),
+                                               dtype=bool)
+
+    def _add_fields(self, names):
+        # make room in sim_data for more variables (e.g. external data)
+        sim_types = {'names': list(names),
+                     'formats': [self._dtype_of(name) for name in names]}
+        new_stuff = numpy.zeros(len(self.sim_timeline), dtype=sim_types)
+        import numpy.lib.recfunctions as rfn
+        self.sim_data = rfn.merge_arrays([self.sim_data, new_stuff],
+                                         flatten=True,
+                                         usemask=False)
+        self._add_masks(names)
+
+    def _fill_gaps(self):
+        from . import gaps
+        for name, method in self.gaps.items():
+            if name in self.graph.definitions or not self.sim_timeline or \
+                    name not in self.sim_data.dtype.names or \
+                    self.sim_data.dtype[name].shape:
+                raise ut.YAMLError("Gaps of " + name + " can't be filled:"
+                                   " it's not a number of the external data")
+            try:
+                self.sim_known[name] = gaps.fill(
+                    self.sim_data[name], self.sim_known[name], method,
+                    self.sim_timeline)
+            except ValueError as error:
+                raise ut.YAMLError(str(error) + " for " + name)
+
+    def _choose_evaluation(self, mode):
+        # lazy evaluation pays off when only a few cells of the timeline are
+        # needed, or when there's no timeline at all
+        if mode in ("eager", "lazy"):
+            return mode
+        if mode != "auto":
+            raise ut.YAMLError("Unknown evaluation mode: " + str(mode))
+        if not self.sim_timeline:
+            return "lazy"
+        # snapshots are taken along the whole timeline
+        if "logging" in self.parameters or self.linear.names or \
+                self.parameters["simulation"]["checkpoints"]:
+            return "eager"
+        needed = sum(last - first + 1
+                     for _, first, last in self.sim_full_step_ranges
+                     if first <= last)
+        slots = len(self.sim_timeline) * len(self.sim_full_step_ranges)
+        return "lazy" if 4 * needed < slots else "eager"
 
     def _build_timeline(self):
         # build timeline: the sequence of steps to evaluate
@@ -151,54 +428,91 @@ class Model:
     def _build_simulation_helpers(self):
         # List the target variables to be evaluated during each simulation, and
         # try to identify some repeatable simulation step. Be aware that each
-        # sim_step_todo can span multiple timesteps
-
-        # find the leaves of the simulation - an indexed target
-        unindex_leaves = {v for v in self.parameters["simulation"]["target"]
-                          if v.is_indexed}
-        # if no target is indexed, but relies on indexed variables
-        if not unindex_leaves:
-            unindex_leaves = set()
-            for target in self.parameters["simulation"]["target"]:
-                # |= is the set union operator
-                unindex_leaves |= {v for v in self.functions[target].inputs
-                                   if v.is_indexed}
-        if not unindex_leaves:
+        # sim_step_todo can span multiple timesteps.
+        # Only what is needed by the targets and the logs is evaluated, and
+        # only on the range of indexes that is actually read.
+        bounds = (self.sim_timeline[0], self.sim_timeline[-1])
+        requests = list()
+        for target in self.parameters["simulation"]["target"]:
+            if target.is_absolutely_indexed:
+                requests.append(DependencyGraph.index_range(target, bounds))
+            else:  # evaluated once the simulation is over
+                requests.append((target.name, bounds[1], bounds[1]))
+        if "logging" in self.parameters and self.parameters["logging"]:
+            for log_file in self.parameters["logging"]:
+                requests += [(v.name, bounds[0], bounds[1]) for v
+                             in self.parameters["logging"][log_file]]
+        self.sim_ranges = self.graph.ranges(requests, bounds)
+        if not any(v.is_indexed for name in self.sim_ranges
+                   for v in self.graph.definitions[name]):
             raise ValueError("Impossible simulation asked for.")
+
         self.sim_step_todo = OrderedDict()
-        # import pdb; pdb.set_trace()
-        # print("unindex_leaves: " + str(unindex_leaves))  # TODO
-        for leaf in unindex_leaves:
-            # stupid way of using a dict...
-            leaf_found = list()
-            [leaf_found.append(key) for key, value
-             in self.variable_names.items() if value == leaf.name]
-            indexed_leaves = leaf_found
-            # print("indexed_leaves: " + str(indexed_leaves))  # TODO
-            precursors = list()
-            # print("self.functions: " + str(self.functions)) # TODO
-            for leaf in indexed_leaves:
-                if leaf not in self.functions or leaf.is_absolutely_indexed:
+        for name in self.graph.order(list(self.sim_ranges)):
+            for leaf in self.graph.definitions[name]:
+                if not leaf.is_relatively_indexed:
                     continue
-                precursors += [leaf]
-                # print("Prec0: " + str(precursors))  # TODO
-                precursors += [v for v in self.functions[leaf].inputs
-                               if v.is_relatively_indexed]
-                # print("Prec0: " + str(precursors))  # TODO
-            # print("Prec1: ", precursors)  # TODO
-            while precursors:
-                dude = precursors.pop()
-                if dude in self.functions:
-                    precursors += [v for v in self.functions[dude].inputs
-                                   if (v.is_relatively_indexed and
-                                       v not in self.sim_step_todo and
-                                       v not in precursors)]
-                    # the dude is added only if is a target to be evaluated
-                    if dude not in self.sim_step_todo:
-                        self.sim_step_todo.update({dude: None})
-                elif dude.is_relatively_indexed:
-                    # but in a function -> leaf of the step
-                    self.sim_step_todo.update({dude: None})
+                # the relative inputs, even the external ones, are leaves of
+                # the step and must come before the dude
+                self.sim_step_todo.update(
+                    {v: None for v in self.functions[leaf].inputs
+                     if v.is_relatively_indexed and not v.is_sliced and
+                     v not in self.sim_step_todo})
+                self.sim_step_todo.update({leaf: None})
+        # where the step actually has something to do
+        self.sim_full_step_ranges = [
+            (v, ) + self.sim_ranges.get(v.name, bounds)
+            for v in self.sim_step_todo]
+        # relative functions with a constant value fill their range at once
+        self.sim_fills = list()
+        for v, first, last in self.sim_full_step_ranges:
+            if v not in self.functions or \
+                    self.functions[v].constant() is None:
+                continue
+            first = max(first, bounds[0] + v.delay)
+            last = min(last, bounds[1] + v.delay)
+            if first <= last:
+                self.sim_fills.append(
+                    (v.name, first, last, self.functions[v].constant()))
+        self.sim_full_step_ranges = [
+            item for item in self.sim_full_step_ranges
+            if item[0] not in self.functions or
+            self.functions[item[0]].constant() is None]
+        # linear time-invariant blocks are evaluated in closed form, the
+        # step by step engine takes care only of their initial conditions
+        pinned = [v for v in itertools.chain(
+                      self.functions, self.parameters["simulation"]["inputs"])
+                  if v.is_absolutely_indexed and not v.is_sliced]
+        self.linear = LinearRecurrence(
+            self.graph, self.functions, self.sim_ranges, bounds, pinned,
+            self.parameters["simulation"]["lengths"])
+        self.sim_step_ranges = [
+            (v, first, last if v.name not in self.linear.names
+             else min(last, self.linear.first - 1))
+            for v, first, last in self.sim_full_step_ranges]
+
+        # the variables that don't depend on the inputs (e.g. on the external
+        # data and t only) are computed by the first simulation, then kept
+        # by the next ones
+        inputs = {v.name for v in self.parameters["simulation"]["inputs"]}
+        self.sim_forcing = set()
+        for name in self.sim_ranges:
+            required = self.graph.required([name])
+            if not any(d in inputs for n in required
+                       for d in self.graph.dependencies[n]) and \
+                    all(v.is_indexed for n in required
+                        for v in self.graph.definitions[n]):
+                self.sim_forcing.add(name)
+        self.sim_pinned_step_ranges = [
+            item for item in self.sim_step_ranges
+            if item[0].name not in self.sim_forcing]
+        self.forcing_ready = False
+
+        # independent strands of the step, each one with its own group
+        shared, strands = self.graph.strands(list(self.sim_ranges))
+        self.sim_strand_of = {name: i + 1 for i, strand in enumerate(strands)
+                              for name in strand}
+        self.sim_strand_of.update({name: 0 for name in shared})
 
         index_of_todo_list = [v.delay for v in self.sim_step_todo]
         self.clock_period = max(index_of_todo_list) - min(index_of_todo_list)
@@ -215,6 +529,7 @@ class Model:
             print("Ignoring useless ", source)
             return
         # read csv and store data in sim_data
+        import csv
         reader = csv.reader(input_f)
         # read first row and check if there's the t column
         headers = next(reader)
@@ -230,71 +545,282 @@ class Model:
         headers_to_add = [h for h in headers
                           if (h not in self.sim_data.dtype.names and h != "t")]
         if headers_to_add:
-            sim_types = {'names': list(headers_to_add),
-                         'formats': ['float'] * len(headers_to_add)}
-            new_stuff = numpy.full(len(self.sim_timeline), numpy.nan,
-                                   dtype=sim_types)
-            import numpy.lib.recfunctions as rfn
-            self.sim_data = rfn.merge_arrays([self.sim_data, new_stuff],
-                                             flatten=True,
-                                             usemask=False)
-        # then insert each line of data into the internal container
+            self._add_fields(headers_to_add)
+        # then gather the data of the steps in the timeline, by column:
+        # empty and nan items are gaps (see gaps.py)
+        steps = {t: i for i, t in enumerate(self.sim_timeline)}
+        columns = {h: ([], []) for h in headers if h != "t"}
+        position = headers.index("t")
         for row in reader:
+            if position >= len(row) or int(row[position]) not in steps:
+                # current model doesn't need data from this row
+                continue
+            idx = steps[int(row[position])]
             for header, item in zip(headers, row):
-                if header == "t":
-                    try:
-                        t = self.sim_timeline.index(int(item))
-                        continue
-                    except ValueError:
-                        # current model doesn't need data from this row
-                        break
-                self.sim_data[header][t] = item
+                item = item.strip()
+                if header != "t" and item and item.lower() != "nan":
+                    columns[header][0].append(idx)
+                    columns[header][1].append(item)
+        for header, (indices, items) in columns.items():
+            if indices:
+                self._store(header, indices, items)
         return True
 
-    def process_input(self, input_data):
+    def process_input(self, input_data, resume=None):
         self._treat_input_data(input_data)
-        # perform the simulation, if the current model requires it
+        result = self._evaluate(resume)
+        # deliver results, vectors an element at a time
+        return ' '.join([str(el) for item in result
+                         for el in (item if numpy.ndim(item) else [item])])
+
+    def process_values(self, values, resume=None):
+        """Evaluate the targets given a sequence of input values.
+
+        The binary counterpart of process_input: values are as many floats
+        as input_size, the targets are returned as a flat numpy array.
+        If resume is a step, the simulation restarts from the latest snapshot
+        taken at or before it (see run_simulation).
+        """
+        if len(values) != self.input_size:
+            raise ValueError("Expected " + str(self.input_size) +
+                             " input values, got " + str(len(values)))
+        self._set_inputs(numpy.asarray(values, dtype=float).tolist())
+        return numpy.hstack(self._evaluate(resume)).astype(float)
+
+    def process_jacobian(self, values):
+        """Evaluate the targets and their derivatives given the inputs.
+
+        Dual numbers are propagated through the functions in a single pass,
+        with max, min and if expressions taking the derivative of the
+        branch chosen. Returns the targets as a flat numpy array and the
+        Jacobian matrix, with a row for each target and a column for each
+        input value.
+        """
+        from . import dual
+        if len(values) != self.input_size:
+            raise ValueError("Expected " + str(self.input_size) +
+                             " input values, got " + str(len(values)))
         if self.sim_timeline:
-            self.run_simulation()
-        # finally evaluate the target variables
-        result = [self._calculate(y) for y
-                  in self.parameters["simulation"]["target"]]
+            # room for dual numbers, with the external data as constants
+            forcing_ready = self.forcing_ready
+            floats = self.sim_data
+            self.sim_data = floats.astype(
+                [(name, 'O', floats.dtype[name].shape)
+                 for name in floats.dtype.names])
+        try:
+            self._set_inputs(dual.seed(values))
+            return dual.split(self._evaluate(), self.input_size)
+        finally:
+            if self.sim_timeline:
+                self.sim_data = floats
+                self.forcing_ready = forcing_ready
+
+    def process_table(self, values):
+        """Evaluate the targets of a model without a timeline on many rows.
+
+        values has a row for each evaluation, with as many values as
+        input_size; each function is evaluated once on the columns of all
+        the rows. Returns the targets as an array, a row for each row of
+        values, with the same results of process_values on each row.
+        """
+        from . import table
+        return table.evaluate(self, values)
+
+    def _use_errors(self):
+        # count the errors of the kernels called by this thread, from zero
+        self.errors.policy = self.parameters["simulation"]["errors"]
+        self.errors.count = 0
+        kernels.use(self.errors)
+        return self.errors
+
+    def _evaluate(self, resume=None):
+        self._use_errors()
+        if self.evaluation == "lazy":
+            if resume is not None:
+                raise ValueError("Only eager simulations can be resumed")
+            result = self._evaluate_lazily()
+        else:
+            # perform the simulation, if the current model requires it
+            if self.sim_timeline:
+                self.run_simulation(resume)
+            # finally evaluate the target variables
+            result = [self._calculate(y) for y
+                      in self.parameters["simulation"]["target"]]
+        self.errors.check()
         # save simulation file
         if "logging" in self.parameters:
             self.print_logs()
-        # deliver results
-        return ' '.join([str(el) for el in result])
+        return result
+
+    def _reset_simulation(self):
+        # forget what was computed by the previous evaluation
+        for name in self.sim_data.dtype.names:
+            if name not in self.graph.definitions:
+                continue
+            if self.forcing_ready and name in self.sim_forcing:
+                continue
+            self.sim_known[name][:] = False
+            if self.sim_data.dtype[name].kind in "fc":
+                self.sim_data[name] = numpy.nan  # as the logs show it
+
+    def _store(self, name, idx, value):
+        # save a value (or a slice of values) in sim_data
+        self.sim_data[name][idx] = value
+        self.sim_known[name][idx] = True
+
+    def _is_known(self, name, idx):
+        # whether a value (or all in a slice) of sim_data is computed
+        return numpy.all(self.sim_known[name][idx])
+
+    def _evaluate_lazily(self):
+        if not self.sim_timeline:
+            return self.lazy.evaluate(self.parameters["simulation"]["target"],
+                                      self.input_data)
+        # the logs need their variables on the whole timeline
+        cells = list()
+        if "logging" in self.parameters:
+            for log_file in self.parameters["logging"]:
+                cells += [(v.name, t)
+                          for v in self.parameters["logging"][log_file]
+                          if v.name in self.graph.definitions
+                          for t in self.sim_timeline]
+        self.current_step = self.sim_timeline[-1]
+        return self.lazy.evaluate(self.parameters["simulation"]["target"],
+                                  self.input_data, self.sim_data,
+                                  self.current_step, cells, self.sim_known)
+
+    def run_simulation(self, resume=None):
+        """Simulate the model along the timeline.
 
-    def run_simulation(self):
+        A snapshot is saved at the beginning of each step in checkpoints. If
+        resume is given, the simulation restarts from the latest snapshot
+        taken at or before that step: what was computed before it is kept,
+        regardless of any change to the inputs.
+        """
+        if resume is not None:
+            start = max((k for k in self.snapshots if k <= resume),
+                        default=None)
+            if start is None:
+                raise ValueError("No snapshot to resume step " + str(resume))
+            snapshot = self.snapshots[start]
+            self.sim_data[:] = snapshot.sim_data
+            for name, known in snapshot.sim_known.items():
+                self.sim_known[name][:] = known
+            step_ranges = snapshot.step_ranges
+        else:
+            start = self.sim_timeline[0]
+            step_ranges = self.sim_step_ranges
+            if self.forcing_ready:
+                step_ranges = self.sim_pinned_step_ranges
+            for name, first, last, value in self.sim_fills:
+                if not (self.forcing_ready and name in self.sim_forcing):
+                    self._store(name, slice(first, last + 1), value)
+            if self.linear.names and not self._run_linear_recurrence():
+                step_ranges = [item for item in self.sim_full_step_ranges
+                               if not self.forcing_ready or
+                               item[0].name not in self.sim_forcing]
+        self._use_errors()
+        strands = self._split_strands(step_ranges)
         # should be for each clock, not for each timestep
-        for t in self.sim_timeline:
+        for t in self.sim_timeline[start - self.sim_timeline[0]:]:
+            if t in self.checkpoints:
+                self.snapshots[t] = Snapshot(
+                    t, self.sim_data.copy(),
+                    {k: v.copy() for k, v in self.sim_known.items()},
+                    step_ranges)
             self.current_step = t
             # print("sim step " + str(t))  # TODO
-            for v in self.sim_step_todo:
-                curr_idx = v.delay + self.current_step
-                if curr_idx > self.sim_timeline[-1]:
-                    continue
-                # print("targetting", v.actualize(self.current_step))  # TODO
-                value = self._calculate(v)
-                self.sim_data[v.name][curr_idx] = value
-                # print("self.sim_data:", self.sim_data)  # TODO
+            if strands:
+                # first what's shared, then each strand on its own
+                self._run_step(strands[0])
+                list(self._executor.map(self._run_strand, strands[1:]))
+            else:
+                self._run_step(step_ranges)
+            if self.errors.count:
+                self.errors.check(" at step " + str(t))
+        if resume is None:
+            self.forcing_ready = True
+
+    def forget_forcing(self):
+        """Compute again, at the next simulation, the variables that don't
+        depend on the inputs: needed after changing what they depend on,
+        e.g. the external data in sim_data."""
+        if self.sim_timeline:
+            self.forcing_ready = False
+
+    def _run_step(self, step_ranges):
+        for v, first, last in step_ranges:
+            curr_idx = v.delay + self.current_step
+            if curr_idx < first or curr_idx > last:
+                continue
+            # print("targetting", v.actualize(self.current_step))  # TODO
+            value = self._calculate(v)
+            self._store(v.name, curr_idx, value)
+            # print("self.sim_data:", self.sim_data)  # TODO
+
+    def _run_strand(self, step_ranges):
+        # a strand, within a thread of the executor
+        kernels.use(self.errors)
+        self._run_step(step_ranges)
+
+    def _split_strands(self, step_ranges):
+        # the step ranges grouped by strand, the shared ones first; None if
+        # the step is better evaluated sequentially
+        if self.threads < 2:
+            return None
+        strands = [list() for _ in range(max(self.sim_strand_of.values(),
+                                             default=0) + 1)]
+        for item in step_ranges:
+            strands[self.sim_strand_of.get(item[0].name, 0)].append(item)
+        strands = strands[:1] + [s for s in strands[1:] if s]
+        if len(strands) < 3:
+            return None
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(self.threads)
+        return strands
+
+    def _run_linear_recurrence(self):
+        # evaluate the linear block from its initial conditions, if known
+        self.current_step = self.sim_timeline[0]
+        initial = dict()
+        for name, j in self.linear.states:
+            idx = self.linear.first - 1 - j
+            if idx < self.sim_timeline[0]:
+                return False
+            try:
+                initial[(name, j)] = self._calculate(
+                    ut.Variable(name + '[' + str(idx) + ']'))
+            except ValueError:
+                return False
+            if math.isnan(initial[(name, j)]):
+                return False
+        for name, (first, values) in self.linear.evaluate(initial).items():
+            self._store(name, slice(first, first + len(values)), values)
+        return True
 
     def _treat_input_data(self, data):
-        data = data.split()
+        data = [float(el) for el in data.split()]
+        if len(data) < self.input_size:
+            self.shutdown()
+        self._set_inputs(data)
+
+    def _set_inputs(self, data):
+        self.invariant_values = dict()
+        if self.sim_timeline:
+            self._reset_simulation()
+        position = 0
         for v in self.parameters["simulation"]["inputs"]:
             if hasattr(v, "length"):
                 # extract the required data
-                try:
-                    el = tuple([float(data.pop(0)) for _ in range(v.length)])
-                except IndexError as err:
-                    msg = "pop from empty list"
-                    if err.args[0][-len(msg):] == msg:
-                        self.shutdown()
+                el = numpy.array(data[position:position + v.length])
+                position += v.length
             else:
-                el = float(data.pop(0))  # it's scalar
+                el = data[position]  # it's scalar
+                position += 1
             # if indexed, add the info also to sim_data
             if self.sim_timeline and v.is_indexed:
-                self.sim_data[v.name][int(v.index)] = el
+                self._store(v.name, int(v.index), el)
             self.input_data[v] = el
         # print("self.input_data:", self.input_data)  # TODO
 
@@ -304,10 +830,10 @@ class Model:
         # given as input to the program
         if target in self.parameters["simulation"]["inputs"]:
             if target.is_indexed:
-                return self.sim_data[target][int(target.index)]
+                return self.sim_data[target.name][int(target.index)]
             else:
                 return self.input_data[target]
-        # already calculated
+        # already calculated (or given)
         if self.sim_timeline and target.name in self.sim_data.dtype.names:
             idx = 0
             try:  # pythonic way? better ask for forgiveness than permission?
@@ -316,23 +842,24 @@ class Model:
                 except TypeError:  # has no delay field => absolute index
                     assert target.is_absolutely_indexed
                     idx = int(target.index)
-                value = self.sim_data[target.name][idx]
-                if not math.isnan(value):
-                    # print("for", target, "found", value)  # TODO
-                    return value
+                # inlined _is_known, it's the hottest spot
+                if self.sim_known[target.name][idx]:
+                    return self.sim_data[target.name][idx]
             except ValueError:  # is sliced!
                 assert target.is_sliced
-                stuff = [int(s) for s in target.index.split(':') if s]
-                # splat operator (LOL)
-                value = self.sim_data[target.name][slice(*stuff)]
-                if not any(math.isnan(v) for v in value):
-                    # print("for", target, "found", value)  # TODO
-                    return value
-                else:
-                    ValueError("nan found for ", target, "in:", value)
+                idx = target.slice
+                if self._is_known(target.name, idx):
+                    return self.sim_data[target.name][idx]
+            # a gap of the external data: there's nothing to compute it with
+            if target.name not in self.graph.definitions:
+                raise ValueError("No value of", target, "at", idx,
+                                 "in the external data")
 
         # if to be calculated
         if target in self.functions:
+            # time invariant, and already calculated
+            if target in self.invariant_values:
+                return self.invariant_values[target]
             # collect the inputs required
             required_variables = self.functions[target].inputs
             for v in required_variables:
@@ -340,14 +867,17 @@ class Model:
                 if (v.is_indexed and not v.is_sliced and
                         v.name in self.sim_data.dtype.names):
                     try:
-                        self.sim_data[v.name][t + v.delay] = v.value
+                        self._store(v.name, t + v.delay, v.value)
                     except TypeError as err:
                         if err.args[0][:24] != "unsupported operand type":
                             raise err
                         assert v.is_absolutely_indexed
-                        self.sim_data[v.name][t] = v.value
+                        self._store(v.name, t, v.value)
             # then calculate
-            return self.functions[target].calculate()
+            value = self.functions[target].calculate()
+            if target in self.time_invariant:
+                self.invariant_values[target] = value
+            return value
         # if is relatively indexed but the current value is in the functions
         if target.is_relatively_indexed:
             actualized_target = target.actualize(t)
@@ -381,58 +911,92 @@ class Model:
                     return self._calculate(alternative_target, diff_t)
         # it's the t
         if target == ut.Variable("t"):
-            return t
+            return t + self.time_origin
         # eventually, give up
         raise ValueError("Variable", target, "is not evaluable.")
 
     def print_logs(self):
-        for log in self.parameters["logging"]:
-            # better to ask forgiveness than permission
-            try:
-                with open(log, "x", newline='') as f:
-                    self._write_log(f, log)
-            except FileExistsError:
-                # there are old logs, so add a new one
-                splitted_log = os.path.splitext(log)
-                old_logs = sorted(glob.glob(splitted_log[0] + "*" +
-                                            splitted_log[1]),
-                                  key=ut.alphanum_key)
-                splitted_log = os.path.splitext(old_logs[-1])
-                new_name = splitted_log[0].rsplit('_', 1)
-                if len(new_name) == 1 or not new_name[1].isdigit():
-                    new_name = splitted_log[0] + '_1' + splitted_log[1]
-                else:
-                    new_name = new_name[0] + '_' + str(int(new_name[1]) + 1) \
-                               + splitted_log[1]
-                with open(new_name, "x", newline='') as f:
-                    self._write_log(f, log)
-
-            except FileNotFoundError:
-                # this happens when filename contains a path, and folder on the
-                # path doesn't exists
-                os.makedirs(os.path.dirname(log))
-                with open(log, "x", newline='') as f:
-                    self._write_log(f, log)
-
-    def _write_log(self, logfile, log_name):
-        logger = csv.writer(logfile)
-        items = self.parameters["logging"][log_name]
-        logger.writerow(['# t'] + items)
-        for t in self.sim_timeline:
-            datas = [self.sim_data[d.name][t] for d in items]
-            logger.writerow([t] + list(datas))
+        self.logs.write(self.sim_timeline, self.sim_data)
+
+    def save(self, path):
+        """Write the model, as built from its sources, to a binary file.
+
+        Functions (their compiled code included), variables, the evaluation
+        schedule and the simulation data, with their layout, are saved as
+        they are: Model.load (or a Model with the file as only source) gets
+        them back without parsing nor compiling anything.
+        """
+        from . import artifact
+        for function in set(self.functions.values()):
+            # the code on columns is compiled now, its tree isn't saved
+            if isinstance(function, ut.Function):
+                function.compile_columns()
+        state = {name: value for name, value in self.__dict__.items()
+                 if name not in Model.runtime}
+        with open(path, "wb") as f:
+            artifact.dump(state, f)
+
+    @classmethod
+    def load(cls, path):
+        """Read a model written by save."""
+        from . import artifact
+        model = cls.__new__(cls)
+        with open(path, "rb") as f:
+            model.__dict__.update(artifact.load(f))
+        model._prepare_runs()
+        return model
+
+    def close(self):
+        """Stop the threads evaluating the strands, if any."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
 
     def shutdown(self):
+        self.close()
         sys.exit(0)
 
 
-if __name__ == "__main__":
+def _profile_startup(model, started, built):
+    # report on stderr the time to the first evaluation, once it's done; the
+    # time waiting for the first inputs (e.g. on stdin) is told apart
+    names = ("process_input", "process_values", "process_jacobian")
+    methods = {name: getattr(model, name) for name in names}
+
+    def first(method):
+        def wrapper(*args, **kwargs):
+            entered = time.perf_counter()
+            result = method(*args, **kwargs)
+            done = time.perf_counter()
+            for name in names:
+                setattr(model, name, methods[name])
+            print("startup profile (seconds)\n"
+                  "  python and imports (cpu) %.4f\n"
+                  "  arguments                %.4f\n"
+                  "  model                    %.4f\n"
+                  "  waiting for inputs       %.4f\n"
+                  "  first evaluation         %.4f\n"
+                  "  to first evaluation      %.4f"
+                  % (started[1], started[2] - started[0],
+                     built - started[2], entered - built, done - entered,
+                     started[1] + built - started[0] + done - entered),
+                  file=sys.stderr)
+            return result
+        return wrapper
+    for name in names:
+        setattr(model, name, first(methods[name]))
+
+
+def main(argv=None):
+    """The command line interface (see --help)."""
+    # wall clock and cpu time so far (from the start of the process)
+    started = [time.perf_counter(), time.process_time()]
     if sys.version_info < (3, 5):
         raise SystemExit("Sorry, you need at least python 3.5.",
                          "C'mon, middle age is finished!")
 
     import argparse
-    from _version import __version__
+    from ._version import __version__
     parser = argparse.ArgumentParser()
     parser.add_argument('--version',
                         action='version',
@@ -441,10 +1005,107 @@ if __name__ == "__main__":
                         help="Any file containing the model specification",
                         type=str,
                         nargs='*')
+    parser.add_argument("--binary",
+                        help="Exchange float64 vectors instead of text lines:"
+                             " each one with a uint32 length header (framed)"
+                             " or exactly as long as the inputs (fixed)",
+                        choices=["framed", "fixed"])
+    parser.add_argument("--jacobian",
+                        help="Print after the targets their derivatives with"
+                             " respect to the inputs, a target at a time",
+                        action="store_true")
+    parser.add_argument("--online",
+                        help="Read the external data a row at a time from"
+                             " this csv file ('-' for stdin), printing the"
+                             " logged variables as soon as each step is done",
+                        metavar="SOURCE")
+    parser.add_argument("--compile",
+                        help="Write the model built from the sources to this"
+                             " binary file (.pdm), to be given as the only"
+                             " source of later runs, and exit",
+                        metavar="OUTPUT")
+    parser.add_argument("--table",
+                        help="Evaluate a model without a timeline on each"
+                             " row of the INPUT table (.csv or .npy),"
+                             " writing the targets to OUTPUT, and exit",
+                        nargs=2, metavar=("INPUT", "OUTPUT"))
+    parser.add_argument("--memory",
+                        help="Measure the memory used to build the model and"
+                             " to evaluate each line of stdin, writing the"
+                             " report to this file at the end",
+                        metavar="REPORT")
+    parser.add_argument("--inputs",
+                        help="The input values of an --online simulation",
+                        default="")
+    parser.add_argument("--startup-profile",
+                        help="Report on stderr the time spent to start, to"
+                             " build the model and to evaluate the first"
+                             " inputs",
+                        action="store_true")
 
-    model = Model(vars(parser.parse_args()))
+    args = vars(parser.parse_args(argv))
+    started.append(time.perf_counter())
+    if args["memory"]:
+        from . import memory
+        report, model = memory.profile(args["sources"], sys.stdin,
+                                       sys.stdout, Model)
+        with open(args["memory"], "w") as f:
+            f.write(str(report))
+        model.shutdown()
+    model = Model(args)
+    if args["startup_profile"]:
+        _profile_startup(model, started, time.perf_counter())
+    if args["compile"]:
+        model.save(args["compile"])
+        model.shutdown()
+    if args["table"]:
+        from . import table
+        table.write(args["table"][1],
+                    model.process_table(table.read(args["table"][0])),
+                    [str(y) for y in model.parameters["simulation"]["target"]])
+        model.shutdown()
+    if args["binary"]:
+        from . import protocol
+        try:
+            protocol.serve(model, sys.stdin.buffer, sys.stdout.buffer,
+                           args["binary"])
+        except (EOFError, ValueError) as exc:
+            # a short or truncated vector is an error, not the end of input
+            model.close()
+            sys.exit("pydmmt: " + str(exc))
+        model.shutdown()
+    if args["online"]:
+        from . import online
+        try:
+            # a short line ends the input of process_input, not this one
+            inputs = [float(el) for el in args["inputs"].split()]
+            if len(inputs) != model.input_size:
+                raise ValueError("Expected " + str(model.input_size) +
+                                 " input values with --inputs, got " +
+                                 str(len(inputs)))
+            model._set_inputs(inputs)
+            if args["online"] == '-':
+                online.run(model, sys.stdin, sys.stdout)
+            else:
+                with open(args["online"], "r", newline='') as source:
+                    online.run(model, source, sys.stdout)
+        except ValueError as exc:
+            # missing inputs or a short row are errors, not the end of input
+            model.close()
+            sys.exit("pydmmt: " + str(exc))
+        model.shutdown()
     try:
         while True:
-            print(model.process_input(input()))
+            if not args["jacobian"]:
+                print(model.process_input(input()))
+                continue
+            values, jacobian = model.process_jacobian(
+                [float(el) for el in input().split()])
+            print(' '.join([str(el) for el
+                            in itertools.chain(values, jacobian.flat)]))
     except EOFError:
         model.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Sample the inputs of a model and evaluate it on the whole design.
+
+    python -m pydmmt.sample model.yml --method lhs --n 100000 -o results.bin
+
+The inputs need their bounds in the YAML, e.g.
+
+    inputs:
+      - "alfa":
+          bounds: [0, 1]
+      - "weights":
+          length: 10
+          bounds: [-1, 1]
+
+Results are appended to the output, after a header line telling the design
+(see read), as rows of little-endian float64: the input values followed by
+the targets. Designs are reproducible from the seed, so an interrupted run
+restarts from the last complete row, if its header is the same: the design
+and the model, told by a hash of its sources. Models without a timeline are
+evaluated a chunk of rows at a time, on columns (see table.py).
+"""
+import hashlib
+import json
+import multiprocessing
+import numpy
+import os
+import sys
+
+from .pydmmt import Model
+
+METHODS = ("lhs", "mc", "saltelli")
+_MAGIC = b"# pydmmt.sample "
+
+
+def input_bounds(model):
+    """List of (lower, upper) bounds, one for each input value."""
+    bounds = list()
+    for v in model.parameters["simulation"]["inputs"]:
+        if not hasattr(v, "bounds"):
+            raise ValueError("No bounds given for input " + str(v))
+        length = getattr(v, "length", 1)
+        if len(v.bounds) == 2 and not hasattr(v.bounds[0], "__len__"):
+            bounds += [tuple(v.bounds)] * length
+        elif len(v.bounds) == length:
+            bounds += [tuple(b) for b in v.bounds]
+        else:
+            raise ValueError("Wrong bounds for input " + str(v))
+    return numpy.array(bounds, dtype=float)
+
+
+def design(bounds, n, method="lhs", seed=None):
+    """Sample n points within bounds, one row each.
+
+    "mc" is plain Monte Carlo, "lhs" a latin hypercube, "saltelli" the
+    n * (d + 2) rows needed to estimate first and total order Sobol indices
+    of d inputs: matrix A, matrix B, then A with the i-th column of B, for
+    each i.
+    """
+    random = numpy.random.RandomState(seed)
+    d = len(bounds)
+    if method == "mc":
+        unit = random.random_sample((n, d))
+    elif method == "lhs":
+        strata = numpy.argsort(random.random_sample((n, d)), axis=0)
+        unit = (strata + random.random_sample((n, d))) / n
+    elif method == "saltelli":
+        a, b = random.random_sample((n, d)), random.random_sample((n, d))
+        mixed = list()
+        for i in range(d):
+            a_b = a.copy()
+            a_b[:, i] = b[:, i]
+            mixed.append(a_b)
+        unit = numpy.vstack([a, b] + mixed)
+    else:
+        raise ValueError("Unknown sampling method: " + str(method))
+    return bounds[:, 0] + unit * (bounds[:, 1] - bounds[:, 0])
+
+
+_model = None
+
+
+def _init_worker(sources):
+    global _model
+    _model = Model({"sources": list(sources)})
+
+
+def _evaluate(rows):
+    if not _model.sim_timeline:
+        return _model.process_table(rows)
+    return numpy.vstack([_model.process_values(row) for row in rows])
+
+
+def _header(method, n, seed, inputs, targets, model=None):
+    # what the rows of an output are, as its first line
+    return _MAGIC + json.dumps(
+        {"method": method, "n": n, "seed": seed, "inputs": inputs,
+         "targets": targets, "model": model}, sort_keys=True).encode() + \
+        b"\n"
+
+
+def _fingerprint(sources):
+    # the SHA-256 of the contents of the sources, so that a run is resumed
+    # with the same model only
+    digest = hashlib.sha256()
+    for source in sources:
+        with open(source, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def read(output):
+    """The design of an output, as a dict, and its rows (one per point)."""
+    with open(output, "rb") as f:
+        header = f.readline()
+        if not header.startswith(_MAGIC):
+            raise ValueError(output + " isn't an output of pydmmt.sample")
+        design = json.loads(header[len(_MAGIC):].decode())
+        rows = numpy.frombuffer(f.read(), dtype='<f8')
+    size = design["inputs"] + design["targets"]
+    return design, rows[:len(rows) // size * size].reshape(-1, size)
+
+
+def run(sources, n, method="lhs", output="results.bin", seed=0, jobs=1,
+        chunk=1000, progress=None):
+    """Evaluate the model in sources on a design, appending to output.
+
+    Returns the number of rows evaluated by this call.
+    """
+    _init_worker(sources)
+    bounds = input_bounds(_model)
+    points = design(bounds, n, method, seed)
+    targets = len(_model.parameters["simulation"]["target"])
+    row_size = (points.shape[1] + targets) * 8
+    header = _header(method, n, seed, points.shape[1], targets,
+                     _fingerprint(sources))
+    # restart after the last complete row of the same design
+    done = 0
+    if os.path.exists(output) and os.path.getsize(output):
+        with open(output, "r+b") as f:
+            found = f.readline()
+            if found != header:
+                raise ValueError(output + " holds another design: " +
+                                 found.decode(errors="replace").strip())
+            done = (os.path.getsize(output) - len(header)) // row_size
+            f.truncate(len(header) + done * row_size)
+    else:
+        with open(output, "wb") as f:
+            f.write(header)
+    chunks = [points[i:i + chunk] for i in range(done, len(points), chunk)]
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker, (sources, ))
+        results = pool.imap(_evaluate, chunks)
+    else:
+        results = map(_evaluate, chunks)
+    try:
+        with open(output, "ab") as f:
+            for rows, values in zip(chunks, results):
+                if values.shape[1] != targets:
+                    raise ValueError("Expected " + str(targets) +
+                                     " targets, one value each")
+                f.write(numpy.hstack([rows, values]).astype('<f8')
+                             .tobytes())
+                f.flush()
+                done += len(rows)
+                if progress:
+                    progress(done, len(points))
+    finally:
+        if pool:
+            pool.terminate()
+    return sum(len(rows) for rows in chunks)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m pydmmt.sample")
+    parser.add_argument("sources",
+                        help="Any file containing the model specification",
+                        nargs='+')
+    parser.add_argument("--method", choices=METHODS, default="lhs")
+    parser.add_argument("--n", type=int, required=True,
+                        help="Number of samples (base samples for saltelli)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of worker processes")
+    parser.add_argument("--chunk", type=int, default=1000,
+                        help="Rows evaluated and written at once")
+    parser.add_argument("-o", "--output", default="results.bin")
+    args = parser.parse_args(argv)
+
+    def progress(done, total):
+        print("\r%d/%d" % (done, total), end='', file=sys.stderr)
+
+    run(args.sources, args.n, args.method, args.output, args.seed,
+        args.jobs, args.chunk, progress)
+    print(file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
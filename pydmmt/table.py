@@ -0,0 +1,78 @@
+"""Evaluate a static model on a whole table of inputs, a column at a time.
+
+Models without a timeline (e.g. examples/calc.yml) are evaluated by
+process_input a row at a time, each target calculating what it needs. Here
+each function is evaluated once, on the columns of all the rows, following
+the order of the dependencies; the results are the same of process_input.
+
+Tables are .npy files or .csv files (comma separated, lines starting with #
+are comments), with a row for each evaluation: the input values in, the
+targets out.
+"""
+import numpy
+import os
+
+
+def evaluate(model, values):
+    """The targets of a static model for each row of values.
+
+    values has a column for each input value (see Model.input_size); returns
+    an array with a row for each row of values.
+    """
+    if model.sim_timeline:
+        raise ValueError("Only models without a timeline are evaluated by"
+                         " columns")
+    values = numpy.asarray(values, dtype=float)
+    if values.ndim != 2 or values.shape[1] != model.input_size:
+        raise ValueError("Expected rows of " + str(model.input_size) +
+                         " input values")
+    rows = len(values)
+    columns = dict()
+    position = 0
+    for v in model.parameters["simulation"]["inputs"]:
+        length = getattr(v, "length", None)
+        if length is None:
+            columns[v.name] = values[:, position]
+            position += 1
+        else:
+            columns[v.name] = values[:, position:position + length]
+            position += length
+    errors = model._use_errors()
+    targets = model.parameters["simulation"]["target"]
+    names = model.graph.required([y.name for y in targets])
+    for name in model.graph.order(names):
+        if name in columns:
+            continue  # given as input
+        output = model.graph.definitions[name][0]
+        function = model.functions[output]
+        missing = [v for v in function.inputs if v.name not in columns]
+        if missing:
+            raise ValueError("Variable " + str(missing[0]) + " is not"
+                             " evaluable by columns")
+        columns[name] = function.calculate_columns(
+            [columns[v.name] for v in function.inputs], rows)
+        errors.check(" computing " + str(output))
+    return numpy.column_stack([columns[y.name] for y in targets]) \
+        if targets else numpy.empty((rows, 0))
+
+
+def read(path):
+    """Read a table of input values from a .npy or .csv file."""
+    if os.path.splitext(path)[1] == ".npy":
+        return numpy.load(path)
+    return numpy.loadtxt(path, delimiter=',', ndmin=2)
+
+
+def write(path, table, header=None):
+    """Write a table to a .npy or .csv file, with header as first comment.
+
+    In .csv files the values are written as process_input would print them.
+    """
+    if os.path.splitext(path)[1] == ".npy":
+        numpy.save(path, table)
+        return
+    with open(path, "w") as f:
+        if header:
+            f.write("# " + ','.join(header) + "\n")
+        for row in table.tolist():
+            f.write(','.join([str(el) for el in row]) + "\n")
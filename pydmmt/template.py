@@ -0,0 +1,53 @@
+"""Templates: parameterized groups of functions, reused by instances."""
+# local import
+from . import util as ut
+
+# compiled functions of the templates met so far, by definition: the same
+# template is parsed and compiled once per process
+_compiled = dict()
+
+
+class Template():
+    """A group of functions, instantiated with a prefix and its parameters.
+
+    definition is the YAML mapping of the template, with its "functions" and
+    the default values of its "parameters" (null if an instance must give
+    one). Parameters are constants of the compiled code, so instances just
+    rename the variables and bind the values.
+    """
+
+    def __init__(self, name, definition):
+        self.name = name
+        if not definition or not definition.get("functions"):
+            raise ut.YAMLError("Template " + name + " has no functions")
+        self.parameters = dict(definition.get("parameters") or dict())
+        texts = tuple(definition["functions"])
+        key = (texts, tuple(sorted(self.parameters)))
+        if key not in _compiled:
+            _compiled[key] = [ut.Function(text, sorted(self.parameters))
+                              for text in texts]
+        self.functions = _compiled[key]
+        self.variable_names = {v.name for f in self.functions
+                               for v in f.inputs + f.outputs} - {'t'}
+
+    def instantiate(self, prefix, parameters=None, bindings=None):
+        """The functions of an instance.
+
+        Each variable gets the prefix, unless bindings maps it with a
+        variable of the model (e.g. {"inflow": "a"}); parameters override
+        the default values.
+        """
+        values = dict(self.parameters)
+        values.update(parameters or dict())
+        unknown = set(values) - set(self.parameters)
+        if unknown:
+            raise ut.YAMLError("Unknown parameters of " + self.name + ": " +
+                               ", ".join(sorted(unknown)))
+        missing = [p for p in sorted(values) if values[p] is None]
+        if missing:
+            raise ut.YAMLError("Missing parameters of " + self.name + ": " +
+                               ", ".join(missing))
+        bindings = bindings or dict()
+        names = {n: bindings.get(n, prefix + n) for n in self.variable_names}
+        return [f.instance(names, [values[p] for p in f.constant_names])
+                for f in self.functions]
@@ -1,10 +1,13 @@
 """Utilities supporting pydmmt."""
 import ast
+import copy
 import math
 import numpy
 import operator as op
 import re
 import string
+# local import
+from . import kernels
 
 
 class YAMLError(ValueError):
@@ -32,6 +35,9 @@ class Variable(TextBased):
                 self.original_string = key
                 if "length" in value.keys():
                     self.length = int(value["length"])
+                if "bounds" in value.keys():
+                    # (lower, upper), or one couple for each element
+                    self.bounds = value["bounds"]
                 break  # allow only one cycle = one variable definition
         else:
             self.original_string = text
@@ -42,6 +48,7 @@ class Variable(TextBased):
         self.is_relatively_indexed = False
         self.is_absolutely_indexed = False
         self.is_sliced = False
+        self.slice = None
 
         self.value = numpy.nan
 
@@ -57,6 +64,9 @@ class Variable(TextBased):
             self.is_relatively_indexed = 't' in self.index
             self.is_absolutely_indexed = 't' not in self.index
             self.is_sliced = ':' in self.index
+            if self.is_sliced and self.is_absolutely_indexed:
+                self.slice = slice(*[int(s) if s.strip() else None
+                                     for s in self.index.split(':')])
             if self.is_relatively_indexed and not self.is_sliced:
                 if self.index.strip() == 't':
                     self.delay = 0
@@ -93,14 +103,23 @@ class Variable(TextBased):
         return True
 
 
-def _power(a, b):
-    if any(abs(n) > 100 for n in [a, b]):
+def _fold_power(a, b):
+    # a ** b, if it is a plain number
+    value = a ** b
+    if isinstance(value, complex) or abs(value) > 1e300:
         raise ValueError((a, b))
-    return op.pow(a, b)
+    return value
 
 
-def mean(a):
-    return sum(a) / len(a)
+def _exp(x):
+    # numbers carrying their own exp (e.g. dual numbers) keep it
+    if hasattr(x, "exp"):
+        return x.exp()
+    return math.exp(x)
+
+
+def vector(*items):
+    return numpy.array(items)
 
 
 def rbf(inputs, param, n_nodes):
@@ -121,7 +140,7 @@ def rbf(inputs, param, n_nodes):
                 idx_p += 2
             else:
                 raise err
-        bases.append(math.exp(-sum(temp)))
+        bases.append(_exp(-sum(temp)))
     output = 0
     for w, base in zip(param[idx_p:idx_p+n_nodes], bases):
         output += base * w
@@ -131,29 +150,50 @@ def rbf(inputs, param, n_nodes):
 
 class Function(TextBased):
     # supported operators and functions
-    accepted_functions = {"sum": sum, "max": max, "min": min, "mean": mean,
-                          "rbf": rbf}
+    accepted_functions = {"sum": kernels.sum, "max": kernels.max,
+                          "min": kernels.min, "mean": kernels.mean,
+                          "abs": kernels.abs, "power": kernels.power,
+                          "exp": kernels.exp, "log": kernels.log,
+                          "sqrt": kernels.sqrt, "clip": kernels.clip,
+                          "where": kernels.where, "rbf": rbf,
+                          # vectors (elementwise, unless stated otherwise)
+                          "vector": vector, "dot": numpy.dot,
+                          "take": numpy.take, "maximum": kernels.maximum,
+                          "minimum": kernels.minimum}
+    # functions that work on columns of values as well (see Columns)
+    columns_functions = {"sum", "max", "min", "mean", "abs", "power", "exp",
+                         "log", "sqrt", "clip", "where", "maximum",
+                         "minimum"}
     accepted_tree_nodes = ((ast.Num, ast.BinOp, ast.UnaryOp, ast.Subscript,
                            ast.Index, ast.Slice, ast.Load, ast.IfExp,
                            ast.Compare) +
                            (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv,
+                            ast.MatMult,
                             ast.Pow, ast.USub, ast.Mod, ast.Lt, ast.Gt,
                             ast.NotEq, ast.Eq))
     accepted_keywords = {"if": None, "else": None}
 
-    def __init__(self, text):
+    def __init__(self, text, constants=()):
         self.original_string = text
         equation_sides = text.replace(')', ' ')\
                              .replace('(', ' ')\
                              .replace(',', ' ')\
                              .split('=', maxsplit=1)
+        # names of constants (e.g. the parameters of a template) used by the
+        # function: the compiled code reads their values from self.constants
+        # which, if constants is a mapping, are taken from there
+        tokens = [el.split('=')[-1] for el in equation_sides[1].split()]
+        self.constant_names = [c for c in constants if c in tokens]
+        self.constants = [constants[c] if isinstance(constants, dict)
+                          else None for c in self.constant_names]
         self.outputs = [Variable(el)
                         for el in equation_sides[0].split()
                         if Variable.is_it(el)]
         # take care of keyword arguments for function (mean(3,5,w=23))
         self.inputs = [Variable(el.split('=')[-1])
                        for el in equation_sides[1].split()
-                       if Variable.is_it(el.split('=')[-1])]
+                       if Variable.is_it(el.split('=')[-1]) and
+                       el.split('=')[-1] not in self.constant_names]
 
         # parse the text and store the result
         # power operator: change ^ in **
@@ -166,17 +206,21 @@ class Function(TextBased):
             raise exc
         tree.lineno = 0
         tree.col_offset = 0
-        if not Function._check_tree(tree, self.inputs):
+        if not Function._check_tree(tree, self.inputs,
+                                    self.constant_names):
             print("While parsing of:", text, ";")
             raise YAMLError("I'm screwed")
         tree = Function.SubstituteVariables(self).visit(tree)
+        tree = Function.Simplify().visit(tree)
+        tree = Function.Kernels().visit(tree)
         ast.fix_missing_locations(tree)
+        self.tree = tree
         a_useful_name = ("<util.py: compiling function " +
                          self.original_string + ">")
         self.compiled = compile(tree, filename=a_useful_name, mode="eval")
 
     @staticmethod
-    def _check_tree(tree, variables):
+    def _check_tree(tree, variables, constants=()):
         # Expression(body=UnaryOp(left=Name(id='x1', ctx=Load()), op=USub()))])
         for node in ast.walk(tree.body):
             if isinstance(node, Function.accepted_tree_nodes):
@@ -189,7 +233,8 @@ class Function(TextBased):
             elif isinstance(node, ast.keyword):
                 continue
             elif isinstance(node, ast.Name):
-                if node.id in Function.accepted_functions:
+                if (node.id in Function.accepted_functions or
+                        node.id in constants):
                     continue
                 if Variable(node.id) not in variables:
                     if node.id not in [v.name for v in variables]:
@@ -259,6 +304,13 @@ class Function(TextBased):
             # substitute names with variables - works only for non subscript
             if node.id in Function.accepted_functions:
                 return node
+            if node.id in self.f.constant_names:
+                text = ("self.constants[" +
+                        str(self.f.constant_names.index(node.id)) + "]")
+                new_node = ast.parse(text, mode="eval").body
+                ast.copy_location(new_node, node)
+                ast.fix_missing_locations(new_node)
+                return new_node
             if Variable(node.id) not in self.f.inputs:
                 raise YAMLError(ast.dump(node))
             text = ("self.inputs[" +
@@ -270,8 +322,269 @@ class Function(TextBased):
             # print(ast.dump(new_node))  # TODO
             return new_node
 
+    class Simplify(ast.NodeTransformer):
+        # fold the operations between numbers and drop the neutral ones
+        # (x * 1, x - 0, ...), computing what python would at run time
+        operators = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul,
+                     ast.Div: op.truediv, ast.FloorDiv: op.floordiv,
+                     ast.Mod: op.mod, ast.Pow: _fold_power}
+        comparisons = {ast.Lt: op.lt, ast.Gt: op.gt, ast.Eq: op.eq,
+                       ast.NotEq: op.ne}
+
+        def visit_BinOp(self, node):
+            self.generic_visit(node)
+            left = node.left.n if isinstance(node.left, ast.Num) else None
+            right = node.right.n if isinstance(node.right, ast.Num) else None
+            operator = self.operators.get(type(node.op))
+            if left is not None and right is not None and operator:
+                try:
+                    value = operator(left, right)
+                except (ArithmeticError, ValueError):
+                    return node  # let it fail at run time, as before
+                return ast.copy_location(ast.Num(n=value), node)
+            if right is not None and (
+                    (isinstance(node.op, (ast.Add, ast.Sub)) and
+                     right == 0) or
+                    (isinstance(node.op, (ast.Mult, ast.Pow)) and
+                     right == 1)):
+                return node.left
+            if left is not None and (
+                    (isinstance(node.op, ast.Add) and left == 0) or
+                    (isinstance(node.op, ast.Mult) and left == 1)):
+                return node.right
+            return node
+
+        def visit_UnaryOp(self, node):
+            self.generic_visit(node)
+            if isinstance(node.op, ast.USub) and isinstance(node.operand,
+                                                            ast.Num):
+                return ast.copy_location(ast.Num(n=-node.operand.n), node)
+            return node
+
+        def visit_Compare(self, node):
+            self.generic_visit(node)
+            if (len(node.ops) == 1 and isinstance(node.left, ast.Num) and
+                    isinstance(node.comparators[0], ast.Num)):
+                value = self.comparisons[type(node.ops[0])](
+                    node.left.n, node.comparators[0].n)
+                return ast.copy_location(ast.NameConstant(value=value), node)
+            return node
+
+        def visit_IfExp(self, node):
+            self.generic_visit(node)
+            if isinstance(node.test, ast.NameConstant):
+                return node.body if node.test.value else node.orelse
+            if isinstance(node.test, ast.Num):
+                return node.body if node.test.n else node.orelse
+            return node
+
+    class Kernels(ast.NodeTransformer):
+        # exponentiation goes through its kernel, that handles the errors
+        def visit_BinOp(self, node):
+            self.generic_visit(node)
+            if isinstance(node.op, ast.Pow):
+                call = ast.parse("power(0, 0)", mode="eval").body
+                call.args = [node.left, node.right]
+                return ast.copy_location(call, node)
+            return node
+
+    class Columns(ast.NodeTransformer):
+        # rewrite the function to evaluate many rows at once, with columns
+        # of values as inputs; rewrite gives None if it can't be done
+        def rewrite(self, tree):
+            self.supported = True
+            tree = self.visit(tree)
+            return tree if self.supported else None
+
+        def visit_Call(self, node):
+            self.generic_visit(node)
+            if (getattr(node.func, "id", None) not in
+                    Function.columns_functions or node.keywords):
+                self.supported = False
+            return node
+
+        def visit_BinOp(self, node):
+            self.generic_visit(node)
+            if isinstance(node.op, ast.MatMult):
+                self.supported = False
+            return node
+
+        def visit_Compare(self, node):
+            self.generic_visit(node)
+            if len(node.ops) != 1:
+                self.supported = False  # chained comparison
+            return node
+
+        def visit_IfExp(self, node):
+            self.generic_visit(node)
+            call = ast.parse("where(0, 0, 0)", mode="eval").body
+            call.args = [node.test, node.body, node.orelse]
+            return ast.copy_location(call, node)
+
     def calculate(self):
-        return eval(self.compiled)
+        return eval(self.compiled, Function.namespace, {"self": self})
+
+    def compile_columns(self):
+        """The code of the function on columns, None if it can't work so."""
+        if not hasattr(self, "columns_compiled"):
+            self.columns_compiled = None
+            tree = Function.Columns().rewrite(copy.deepcopy(self.tree))
+            if tree is not None:
+                ast.fix_missing_locations(tree)
+                self.columns_compiled = compile(
+                    tree, filename="<util.py: compiling columns of " +
+                    self.original_string + ">", mode="eval")
+        return self.columns_compiled
+
+    def calculate_columns(self, columns, rows):
+        """Evaluate the function on many rows at once.
+
+        columns are the values of the inputs, an array each with a row for
+        each element. Functions that can't work on columns are evaluated a
+        row at a time, with the same results.
+        """
+        if self.compile_columns() is None:
+            return self._calculate_rows(columns, rows)
+        for v, column in zip(self.inputs, columns):
+            v.value = column
+        errors = kernels.current()
+        count = errors.count
+        # a row at a time, operators on floats raise (e.g. division by zero)
+        # where numpy gives inf or nan: on such errors the rows are evaluated
+        # one by one, as process_input does
+        try:
+            with numpy.errstate(divide="raise", over="raise",
+                                invalid="raise", under="ignore"):
+                value = numpy.asarray(eval(self.columns_compiled,
+                                           Function.namespace,
+                                           {"self": self}))
+        except FloatingPointError:
+            value = None
+        if value is None or errors.count != count:
+            # both branches of if expressions are evaluated: the errors may
+            # be in the branches not taken
+            errors.count = count
+            value = self._calculate_rows(columns, rows)
+        if value.ndim == 0:
+            return numpy.full(rows, value)
+        return value
+
+    def _calculate_rows(self, columns, rows):
+        values = list()
+        for row in range(rows):
+            for v, column in zip(self.inputs, columns):
+                # numbers as python floats, as process_input gives them
+                v.value = column[row] if numpy.ndim(column[row]) \
+                    else column[row].item()
+            values.append(self.calculate())
+        return numpy.array(values)
+
+    def constant(self):
+        """The value of the function if it is a number, None otherwise."""
+        if isinstance(self.tree.body, ast.Num):
+            return self.tree.body.n
+        return None
+
+    def instance(self, names, constants=()):
+        """A copy of the function sharing its compiled code.
+
+        names maps the names of the variables with the ones of the copy, e.g.
+        "s" -> "res1_s"; constants are the values of the parameters.
+        """
+        item = copy.copy(self)
+        item.inputs = [Variable(names.get(v.name, v.name) +
+                                v.original_string[len(v.name):])
+                       for v in self.inputs]
+        item.outputs = [Variable(names.get(v.name, v.name) +
+                                 v.original_string[len(v.name):])
+                        for v in self.outputs]
+        item.constants = list(constants)
+        values = dict(zip(self.constant_names, item.constants))
+        values.update(names)
+        item.original_string = re.sub(
+            r"[A-Za-z_]\w*",
+            lambda m: str(values.get(m.group(0), m.group(0))),
+            self.original_string)
+        return item
+
+    def linear_form(self):
+        """Coefficients of the function, if it is affine in its inputs.
+
+        Returns a ({input position: coefficient}, constant) tuple, or None
+        if the expression is not a linear combination of the inputs with
+        constant coefficients (e.g. "1.6 * n2[t] + 1.2 * n3[t]" gives
+        ({0: 1.6, 1: 1.2}, 0)).
+        """
+        return Function._linear_form(self.tree.body, self.constants)
+
+    @staticmethod
+    def _linear_form(node, constants=()):
+        if isinstance(node, ast.Num):
+            return dict(), node.n
+        position = Function._input_position(node)
+        if position is not None:
+            return {position: 1}, 0
+        position = Function._constant_position(node)
+        if position is not None:
+            if numpy.ndim(constants[position]) != 0:
+                return None  # an array
+            return dict(), constants[position]
+        if isinstance(node, ast.UnaryOp):
+            operand = Function._linear_form(node.operand, constants)
+            if operand is None:
+                return None
+            if isinstance(node.op, ast.USub):
+                return Function._scale(operand, -1)
+            return operand if isinstance(node.op, ast.UAdd) else None
+        if not isinstance(node, ast.BinOp):
+            return None
+        left = Function._linear_form(node.left, constants)
+        right = Function._linear_form(node.right, constants)
+        if left is None or right is None:
+            return None
+        if isinstance(node.op, (ast.Add, ast.Sub)):
+            if isinstance(node.op, ast.Sub):
+                right = Function._scale(right, -1)
+            coefficients = dict(left[0])
+            for position, c in right[0].items():
+                coefficients[position] = coefficients.get(position, 0) + c
+            return coefficients, left[1] + right[1]
+        if isinstance(node.op, ast.Mult):
+            if not left[0]:
+                return Function._scale(right, left[1])
+            if not right[0]:
+                return Function._scale(left, right[1])
+        if isinstance(node.op, ast.Div) and not right[0] and right[1] != 0:
+            return Function._scale(left, 1 / right[1])
+        return None
+
+    @staticmethod
+    def _scale(form, factor):
+        return {p: c * factor for p, c in form[0].items()}, form[1] * factor
+
+    @staticmethod
+    def _input_position(node):
+        # the i of a node "self.inputs[i].value" made by SubstituteVariables
+        try:
+            if (node.attr == "value" and node.value.value.attr == "inputs"):
+                return node.value.slice.value.n
+        except AttributeError:
+            pass
+        return None
+
+    @staticmethod
+    def _constant_position(node):
+        # the i of a node "self.constants[i]" made by SubstituteVariables
+        try:
+            if node.value.attr == "constants":
+                return node.slice.value.n
+        except AttributeError:
+            pass
+        return None
+
+
+# what the compiled functions see: the functions of the language only
+Function.namespace = dict(Function.accepted_functions, __builtins__=dict())
 
 
 # sorting files in human sorting
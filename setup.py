@@ -45,6 +45,9 @@ setup(
     ],
     package_dir={'pydmmt': 'pydmmt'},
     include_package_data=True,
+    entry_points={
+        'console_scripts': ['pydmmt = pydmmt.pydmmt:main'],
+    },
     install_requires=[
     ],
     license='MIT',
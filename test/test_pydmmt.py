@@ -181,3 +181,1010 @@ def test_pydmmt_function_library():
     #
     model = pydmmt.Model({"sources": ["examples/fibonacci.yml"]})
     assert model._calculate(ut.Variable("F[1]")) == 1
+
+
+def test_pydmmt_dead_code_elimination(tmpdir):
+    from pydmmt import util as ut
+    #
+    source = tmpdir.join("model.yml")
+    source.write('simulation:\n'
+                 '  target: ["x[5]"]\n'
+                 'functions:\n'
+                 '  - "x[t+1] = x[t] + 1"\n'
+                 '  - "x[0] = 0"\n'
+                 '  - "indicator[t+1] = x[t] * 2"\n'
+                 '  - "far[t] = x[t] + 1"\n'
+                 '  - "y[t] = far[t+3]"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    assert "indicator" not in model.sim_data.dtype.names
+    assert ut.Variable("indicator[t+1]") not in model.sim_step_todo
+    assert model.sim_ranges == {"x": (0, 5)}
+    assert model.process_input("") == "5.0"
+    #
+    model = pydmmt.Model({"sources": ["examples/leslie.yml"]})
+    assert model.sim_ranges["N"] == (9, 10)
+    assert model.sim_ranges["AB"] == (10, 10)
+
+
+def test_pydmmt_linear_recurrence(tmpdir):
+    model = pydmmt.Model({"sources": ["examples/leslie.yml"]})
+    assert set(model.linear.names) == {"n1", "n2", "n3", "N"}
+    assert "AB" not in model.linear.names
+    model = pydmmt.Model({"sources": ["examples/fibonacci.yml"]})
+    assert model.linear.states == [("F", 0), ("F", 1)]
+    model = pydmmt.Model({"sources": ["examples/leslie_inputs.yml"]})
+    assert not model.linear.names
+    # a far horizon target is reached by repeated squaring
+    source = tmpdir.join("model.yml")
+    source.write('simulation:\n'
+                 '  target: ["x[5000]", "y[5000]"]\n'
+                 '  inputs: ["x[0]"]\n'
+                 'functions:\n'
+                 '  - "x[t+1] = 0.5 * x[t] + 1"\n'
+                 '  - "y[t+1] = 2 * x[t+1] - 4"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    assert model.linear.names == ["x", "y"]
+    results = [float(r) for r in model.process_input("10").split()]
+    assert abs(results[0] - 2) < 1e-12
+    assert abs(results[1]) < 1e-12
+
+
+def test_pydmmt_lazy_evaluation(tmpdir):
+    model = pydmmt.Model({"sources": ["examples/calc.yml"]})
+    assert model.evaluation == "lazy"
+    assert model.process_input("3 2") == "5.0 9.0 3.0 5.0 2.0"
+    # a far target depending on a short window of the timeline
+    source = tmpdir.join("model.yml")
+    source.write('simulation:\n'
+                 '  target: ["y[100000]"]\n'
+                 'functions:\n'
+                 '  - "x[t] = t * 2"\n'
+                 '  - "x[0] = 0"\n'
+                 '  - "y[t+1] = x[t] + x[t+1]"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    assert model.evaluation == "lazy"
+    assert model.process_input("") == "399998.0"
+    # snapshots need the whole timeline
+    source.write('simulation:\n'
+                 '  target: ["y[100000]"]\n'
+                 '  checkpoints: [99990]\n'
+                 'functions:\n'
+                 '  - "x[t] = t * 2"\n'
+                 '  - "x[0] = 0"\n'
+                 '  - "y[t+1] = x[t] + x[t+1]"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    assert model.evaluation == "eager"
+    # same results both ways, also evaluating twice
+    for evaluation in ("lazy", "eager"):
+        model = pydmmt.Model({"sources": ["examples/leslie.yml"]})
+        model.evaluation = evaluation
+        for _ in range(2):
+            output = model.process_input("40 0 20")
+            results = [float(item) for item in output.split()]
+            assert abs(results[0] - 875.8826106880001) < 0.000001
+            assert abs(results[1] - 1.333728647970054) < 0.000001
+
+
+def test_pydmmt_binary_protocol():
+    from io import BytesIO
+    import numpy
+    from pydmmt import protocol
+    #
+    model = pydmmt.Model({"sources": ["examples/calc.yml"]})
+    assert model.input_size == 2
+    results = model.process_values([3, 2])
+    assert list(results) == [5, 9, 3, 5, 2]
+    # framed: uint32 length header, then the float64 values
+    instream = BytesIO()
+    protocol.write_frame(instream, [3, 2])
+    protocol.write_frame(instream, [.1, .1])
+    instream.seek(0)
+    outstream = BytesIO()
+    protocol.serve(model, instream, outstream)
+    outstream.seek(0)
+    assert list(protocol.read_frame(outstream)) == [5, 9, 3, 5, 2]
+    assert protocol.read_frame(outstream)[0] == 0.2
+    assert protocol.read_frame(outstream) is None
+    # fixed: no header at all
+    instream = BytesIO(numpy.array([40, 0, 20], dtype='<f8').tobytes())
+    outstream = BytesIO()
+    model = pydmmt.Model({"sources": ["examples/leslie.yml"]})
+    protocol.serve(model, instream, outstream, "fixed")
+    results = numpy.frombuffer(outstream.getvalue(), dtype='<f8')
+    assert abs(results[0] - 875.8826106880001) < 0.000001
+    assert abs(results[1] - 1.333728647970054) < 0.000001
+
+
+def test_pydmmt_binary_executable():
+    from subprocess import Popen, PIPE
+    import struct
+    p = Popen(["pydmmt/pydmmt.py", "--binary", "framed", "examples/calc.yml"],
+              stdin=PIPE, stdout=PIPE)
+    output = p.communicate(struct.pack('<Idd', 2, 3, 2))[0]
+    assert struct.unpack('<I5d', output) == (5, 5, 9, 3, 5, 2)
+    assert p.returncode == 0
+    # short or truncated vectors are errors
+    p = Popen(["pydmmt/pydmmt.py", "--binary", "framed", "examples/calc.yml"],
+              stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    output, errors = p.communicate(struct.pack('<IddId', 2, 3, 2, 1, 3))
+    assert struct.unpack('<I5d', output) == (5, 5, 9, 3, 5, 2)
+    assert p.returncode != 0 and b"Expected 2 input values" in errors
+    p = Popen(["pydmmt/pydmmt.py", "--binary", "fixed", "examples/calc.yml"],
+              stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    output, errors = p.communicate(struct.pack('<ddd', 3, 2, 1))
+    assert struct.unpack('<5d', output) == (5, 9, 3, 5, 2)
+    assert p.returncode != 0 and b"Truncated frame" in errors
+
+
+def test_pydmmt_resume_from_snapshot(tmpdir):
+    source = tmpdir.join("model.yml")
+    source.write('simulation:\n'
+                 '  target: ["x[100]"]\n'
+                 '  inputs: ["alfa"]\n'
+                 '  checkpoints: [50]\n'
+                 'functions:\n'
+                 '  - "x[t+1] = x[t] + u[t]"\n'
+                 '  - "u[t] = alfa if t > 49 else 1"\n'
+                 '  - "x[0] = 0"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    assert model.process_input("2") == "150.0"
+    assert list(model.snapshots) == [50]
+    assert model.snapshots[50].sim_data["x"][50] == 50
+    # the policy changes only after step 50
+    assert model.process_input("3", resume=50) == "200.0"
+    assert model.process_input("3", resume=70) == "200.0"
+    assert model.process_values([4], resume=50)[0] == 250
+    try:
+        model.process_input("3", resume=10)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError
+
+
+def test_pydmmt_parallel_strands(tmpdir):
+    model = pydmmt.Model({"sources": ["examples/test_lake_substepInteg.yml"]})
+    shared, strands = model.graph.strands(list(model.sim_ranges))
+    assert {"h", "r", "u", "a"} <= set(shared)
+    assert {frozenset(s) for s in strands} == {
+        frozenset(["avg_h_excess", "h_excess"]),
+        frozenset(["avg_irr_deficit", "irr_deficit"]),
+        frozenset(["avg_hyd_deficit", "hyd_deficit", "HP"]),
+        frozenset(["avg_r_excess", "r_excess"])}
+    sequential = model.process_input(".3")
+    model.threads = 4
+    assert len(model._split_strands(model.sim_step_ranges)) == 5
+    assert model.process_input(".3") == sequential
+    model.close()
+    assert model._executor is None
+    # g isn't stored: the strands reading it are evaluated together
+    source = tmpdir.join("model.yml")
+    source.write('simulation:\n'
+                 '  target: ["sp", "sq", "sw"]\n'
+                 '  inputs: ["k"]\n'
+                 '  threads: 2\n'
+                 'functions:\n'
+                 '  - "x[t+1] = x[t] + k"\n'
+                 '  - "x[0] = 0"\n'
+                 '  - "g = x[t] * 2"\n'
+                 '  - "p[t+1] = g + 1"\n'
+                 '  - "q[t+1] = g - 1"\n'
+                 '  - "w[t+1] = x[t] * 3"\n'
+                 '  - "sp = sum(p[1:50])"\n'
+                 '  - "sq = sum(q[1:50])"\n'
+                 '  - "sw = sum(w[1:50])"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    shared, strands = model.graph.strands(list(model.sim_ranges))
+    assert {"x", "g"} <= set(shared)
+    assert {frozenset(s) for s in strands} == {
+        frozenset(["sp", "p", "sq", "q"]), frozenset(["sw", "w"])}
+    assert model.process_input("1") == "2401.0 2303.0 3528.0"
+    model.close()
+
+
+def test_pydmmt_sample(tmpdir):
+    import numpy
+    from pydmmt import sample
+    #
+    bounds = numpy.array([[0, 1], [10, 20]], dtype=float)
+    points = sample.design(bounds, 50, "lhs", seed=1)
+    assert points.shape == (50, 2)
+    # one point per stratum in each dimension
+    assert sorted((points[:, 0] * 50).astype(int)) == list(range(50))
+    assert sorted(((points[:, 1] - 10) * 5).astype(int)) == list(range(50))
+    assert sample.design(bounds, 5, "saltelli").shape == (20, 2)
+    #
+    source = tmpdir.join("model.yml")
+    source.write('simulation:\n'
+                 '  target: ["y1", "y2"]\n'
+                 '  inputs:\n'
+                 '    - "x1":\n'
+                 '        bounds: [0, 1]\n'
+                 '    - "x2":\n'
+                 '        bounds: [1, 2]\n'
+                 'functions:\n'
+                 '  - "y1 = x1 + x2"\n'
+                 '  - "y2 = x1 * x2"\n')
+    output = str(tmpdir.join("results.bin"))
+    assert sample.run([str(source)], 30, "mc", output, chunk=7) == 30
+    design, rows = sample.read(output)
+    assert design["method"] == "mc" and rows.shape == (30, 4)
+    assert numpy.allclose(rows[:, 2], rows[:, 0] + rows[:, 1])
+    assert numpy.allclose(rows[:, 3], rows[:, 0] * rows[:, 1])
+    # an interrupted run is completed, a complete one is left alone
+    header = len(sample._header("mc", 30, 0, 2, 2,
+                                sample._fingerprint([str(source)])))
+    with open(output, "r+b") as f:
+        f.truncate(header + 10 * 32 + 5)
+    assert sample.run([str(source)], 30, "mc", output, jobs=2) == 20
+    assert (sample.read(output)[1] == rows).all()
+    assert sample.run([str(source)], 30, "mc", output) == 0
+    # but not with another design
+    import pytest
+    with pytest.raises(ValueError):
+        sample.run([str(source)], 30, "mc", output, seed=1)
+    # nor with another model
+    source.write(source.read().replace("x1 * x2", "x1 / x2"))
+    with pytest.raises(ValueError):
+        sample.run([str(source)], 30, "mc", output)
+
+
+def test_pydmmt_jacobian():
+    import numpy
+    import pytest
+    #
+    model = pydmmt.Model({"sources": ["examples/calc.yml"]})
+    values, jacobian = model.process_jacobian([3, 2])
+    assert list(values) == [5, 9, 3, 5, 2]
+    # y2 = x1 ^ x2: x2 * x1 ^ (x2 - 1) and log(x1) * x1 ^ x2
+    assert numpy.allclose(jacobian[1], [6, numpy.log(3) * 9])
+    # max and min take the branch chosen
+    assert list(jacobian[2]) == [1, 0]
+    assert list(jacobian[4]) == [0, 1]
+    # with no logarithm of x1: nan, or 0 for x1 = 0
+    values, jacobian = model.process_jacobian([-3, 2])
+    assert list(values) == [-1, 9, 2, 2, -3]
+    assert jacobian[1][0] == -6 and numpy.isnan(jacobian[1][1])
+    values, jacobian = model.process_jacobian([0, 2])
+    assert list(jacobian[1]) == [0, 0]
+    # x1 ^ x2 at x1 = 0 for x2 < 1: an infinite slope, as the policy says
+    with pytest.raises(FloatingPointError):
+        model.process_jacobian([0, .5])
+    model.parameters["simulation"]["errors"] = "nan"
+    values, jacobian = model.process_jacobian([0, .5])
+    assert values[1] == 0
+    assert numpy.isnan(jacobian[1][0]) and jacobian[1][1] == 0
+    # x1 ^ 0 doesn't move with x1
+    assert model.process_jacobian([0, 0])[1][1][0] == 0
+    # against finite differences, through rbf, max and if expressions
+    model = pydmmt.Model(
+        {"sources": ["examples/test_lake_substepInteg_rbf.yml"]})
+    weights = [.5, .3, .5, .3, .5, .3, .2, .3, .4, .1]
+    values, jacobian = model.process_jacobian(weights)
+    assert numpy.allclose(values, model.process_values(weights))
+    assert jacobian.shape == (4, 10)
+    for i in (0, 9):
+        shifted = list(weights)
+        shifted[i] += 1e-6
+        difference = (model.process_values(shifted) - values) / 1e-6
+        assert numpy.allclose(jacobian[:, i], difference, atol=1e-3)
+    # the linear recurrence block carries derivatives as well
+    model = pydmmt.Model({"sources": ["examples/leslie.yml"]})
+    values, jacobian = model.process_jacobian([40, 0, 20])
+    shifted = model.process_values([40, 0, 20.001])
+    assert numpy.allclose(jacobian[:, 2], (shifted - values) / .001,
+                          rtol=1e-3)
+
+
+def test_pydmmt_online(tmpdir):
+    from io import StringIO
+    from subprocess import Popen, PIPE
+    import math
+    import pytest
+    from pydmmt import online
+    # a lake fed by a stream of inflow forecasts
+    source = tmpdir.join("model.yml")
+    source.write('simulation:\n'
+                 '  target: ["h[50]"]\n'
+                 '  inputs: ["alfa"]\n'
+                 'functions:\n'
+                 '  - "h[t+1] = h[t] + a[t+1] - r[t+1]"\n'
+                 '  - "r[t+1] = min(h[t], alfa * u[t])"\n'
+                 '  - "u[t] = h[t-1]"\n'
+                 '  - "u[0] = 0"\n'
+                 '  - "h[0] = 100"\n'
+                 'logging:\n'
+                 '  ' + str(tmpdir.join("lake.log")) + ': ["h[t]", "r[t]"]\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    model._treat_input_data("0.3")
+    simulation = online.OnlineSimulation(model)
+    assert simulation.push({"t": 0, "a": 5}) == []
+    steps = list()
+    for t in range(1, 1001):
+        steps += simulation.push({"t": t, "a": 10 + t % 7})
+        # only the window read by the lags is kept
+        assert len(simulation.memo) < 12
+    assert [s for s, _ in steps] == list(range(1000))
+    # same as the batch simulation
+    h = 100
+    u = 0
+    for t in range(50):
+        h, u = h + 10 + (t + 1) % 7 - min(h, .3 * u), h
+        assert abs(steps[t + 1][1][0] - h) < 1e-9
+    # the target, once evaluated, and for good
+    assert math.isnan(steps[48][1][2])
+    assert steps[49][1][2] == steps[999][1][2] == steps[50][1][0]
+    # through a pipe
+    stream = StringIO("# t,a\n0,5\n1,11\n2,12\n")
+    outstream = StringIO()
+    online.run(model, stream, outstream)
+    lines = outstream.getvalue().split()
+    assert lines[0] == "#" and lines[1] == "t,h[t],r[t],h[50]"
+    assert lines[2:] == ["0,100.0,nan,nan", "1,111.0,0.0,nan"]
+    # short rows and missing inputs are errors, in and out of the executable
+    with pytest.raises(ValueError):
+        online.run(model, StringIO("# t,a\n0,5\n1\n"), StringIO())
+    p = Popen(["pydmmt/pydmmt.py", str(source), "--online", "-"],
+              stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    errors = p.communicate(b"# t,a\n0,5\n")[1]
+    assert p.returncode != 0 and b"Expected 1 input values" in errors
+    p = Popen(["pydmmt/pydmmt.py", str(source), "--online", "-", "--inputs",
+               ".3"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    output, errors = p.communicate(b"# t,a\n0,5\n\n1,11\n2,12\n3\n")
+    assert output.split()[2:] == [b"0,100.0,nan,nan", b"1,111.0,0.0,nan"]
+    assert p.returncode != 0 and b"Line 6 of the stream" in errors
+    # external data read at an absolute index is never dropped
+    source.write('simulation:\n'
+                 '  target: ["s[20]"]\n'
+                 'functions:\n'
+                 '  - "s[t+1] = s[t] + a[t+1] - a[0]"\n'
+                 '  - "s[0] = 0"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    simulation = online.OnlineSimulation(model)
+    steps = list()
+    for t in range(31):
+        steps += simulation.push({"t": t, "a": 5 + t})
+    assert len(steps) == 30 and steps[-1][1] == [435, 210]
+
+
+def test_pydmmt_receding_horizon(tmpdir):
+    import numpy
+    import pytest
+    from pydmmt import horizon
+    source = tmpdir.join("model.yml")
+    source.write('simulation:\n'
+                 '  target: ["h[5]", "clock[5]"]\n'
+                 '  inputs: ["alfa"]\n'
+                 'functions:\n'
+                 '  - "h[t+1] = h[t] + a[t+1] - alfa * h[t]"\n'
+                 '  - "h[0] = 100"\n'
+                 '  - "clock[t] = t"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    inflow = numpy.arange(20.)
+    mpc = horizon.RecedingHorizon(model, {"a": inflow})
+
+    def simulate(h, start, alfa):
+        for t in range(start + 1, start + 6):
+            h = h + inflow[t] - alfa * h
+        return h
+
+    results = mpc.evaluate([[.1], [.2]])
+    assert numpy.allclose(results, [[simulate(100, 0, .1), 5],
+                                    [simulate(100, 0, .2), 5]])
+    # the next window starts from where the chosen one was after a step
+    mpc.advance([.1])
+    h = 100 + inflow[1] - .1 * 100
+    assert numpy.allclose(mpc.evaluate([.2]), [[simulate(h, 1, .2), 6]])
+    # a measure replaces the simulated state
+    mpc.advance([.2], {"h": 50})
+    assert mpc.origin == 2
+    assert numpy.allclose(mpc.evaluate([.3]), [[simulate(50, 2, .3), 7]])
+    # the floating point errors of the targets are checked too
+    source.write('simulation:\n'
+                 '  target: ["y"]\n'
+                 '  inputs: ["alfa"]\n'
+                 'functions:\n'
+                 '  - "h[t+1] = h[t] - alfa"\n'
+                 '  - "h[0] = 1"\n'
+                 '  - "y = log(h[5])"\n'
+                 '  - "clock[t] = t"\n')
+    mpc = horizon.RecedingHorizon(pydmmt.Model({"sources": [str(source)]}))
+    assert numpy.allclose(mpc.evaluate([0]), [[0]])
+    with pytest.raises(FloatingPointError):
+        mpc.evaluate([1])
+
+
+def test_pydmmt_dtypes(tmpdir):
+    import numpy
+    lake = "examples/test_lake_substepInteg.yml"
+    options = tmpdir.join("dtypes.yml")
+    options.write('simulation:\n'
+                  '  dtype: float32\n'
+                  '  dtypes: {day: int32, is_morning: bool}\n')
+    reference = pydmmt.Model({"sources": [lake]})
+    expected = reference.process_values([.3])
+    for evaluation in ("eager", "lazy"):
+        model = pydmmt.Model({"sources": [lake, str(options)]})
+        model.evaluation = evaluation
+        assert model.sim_data.dtype["h"] == numpy.float32
+        assert model.sim_data.dtype["day"] == numpy.int32
+        assert model.sim_data.dtype["is_morning"] == numpy.bool_
+        for _ in range(2):
+            assert numpy.allclose(model.process_values([.3]), expected,
+                                  rtol=1e-4)
+        assert list(model.sim_data["day"][23:26]) == [0, 1, 1]
+        assert list(model.sim_data["is_morning"][23:26]) == [0, 1, 0]
+
+
+def test_pydmmt_templates(tmpdir):
+    from pydmmt import util as ut
+    source = tmpdir.join("model.yml")
+    source.write('templates:\n'
+                 '  reservoir:\n'
+                 '    parameters: {capacity: null, k: 0.5}\n'
+                 '    functions:\n'
+                 '      - "s[t+1] = s[t] + inflow[t+1] - r[t+1]"\n'
+                 '      - "r[t+1] = k * s[t]"\n'
+                 '      - "s[0] = capacity / 2"\n'
+                 'instances:\n'
+                 '  up:\n'
+                 '    template: reservoir\n'
+                 '    parameters: {capacity: 100}\n'
+                 '    bindings: {inflow: a}\n'
+                 '  down:\n'
+                 '    template: reservoir\n'
+                 '    parameters: {capacity: 40, k: 0.25}\n'
+                 '    bindings: {inflow: up_r}\n'
+                 'simulation:\n'
+                 '  target: ["down_s[3]", "up_s[3]"]\n'
+                 'functions:\n'
+                 '  - "a[t] = 10"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    up = model.functions[ut.Variable("up_r[t+1]")]
+    down = model.functions[ut.Variable("down_r[t+1]")]
+    assert str(down) == "down_r[t+1] = 0.25 * down_s[t]"
+    # compiled once, also across models
+    assert up.compiled is down.compiled
+    other = pydmmt.Model({"sources": [str(source)]})
+    assert other.functions[ut.Variable("up_r[t+1]")].compiled is up.compiled
+    assert "up_r" in model.linear.names
+    assert model.process_input("") == "49.375 23.75"
+
+
+def test_pydmmt_compiled_model(tmpdir, monkeypatch):
+    from subprocess import Popen, PIPE, STDOUT
+    import numpy
+    import pytest
+    from pydmmt import artifact as compiled
+    weights = ".5 .3 .5 .3 .5 .3 .2 .3 .4 .1"
+    model = pydmmt.Model(
+        {"sources": ["examples/test_lake_substepInteg_rbf.yml"]})
+    artifact = str(tmpdir.join("lake.pdm"))
+    model.save(artifact)
+    calc = pydmmt.Model({"sources": ["examples/calc.yml"]})
+    calc_artifact = str(tmpdir.join("calc.pdm"))
+    calc.save(calc_artifact)
+    # nothing is parsed nor compiled on load
+    from pydmmt import util as ut
+    from pydmmt.graph import DependencyGraph
+
+    def refused(*args, **kwargs):
+        raise AssertionError("built again on load")
+    monkeypatch.setattr(ut.Function, "__init__", refused)
+    monkeypatch.setattr(DependencyGraph, "__init__", refused)
+    monkeypatch.setattr(ut, "compile", refused, raising=False)
+    loaded = pydmmt.Model.load(artifact)
+    assert loaded.process_input(weights) == model.process_input(weights)
+    rows = numpy.arange(3. * calc.input_size).reshape(3, calc.input_size)
+    assert numpy.array_equal(
+        pydmmt.Model.load(calc_artifact).process_table(rows),
+        calc.process_table(rows))
+    monkeypatch.undo()
+    # the classes of the model only, with code using its names only
+    with open(artifact, "rb") as f:
+        state = compiled.load(f)
+    assert state["graph"].functions is state["functions"]
+    f = open(artifact, "rb").read()
+    source = tmpdir.join("tampered.pdm")
+    source.write_binary(f.replace(b'"class": "Variable"',
+                                  b'"class": "Popen"   '))
+    with pytest.raises(KeyError):
+        pydmmt.Model.load(str(source))
+    # wrong files are refused
+    source = tmpdir.join("model.pdm")
+    source.write_binary(b"PDMM\x01\x02\x07")
+    with pytest.raises(ValueError):
+        pydmmt.Model({"sources": [str(source)]})
+    # from the command line, external data included
+    artifact = str(tmpdir.join("leslie.pdm"))
+    p = Popen(["pydmmt/pydmmt.py", "examples/leslie_inputs.yml",
+               "--compile", artifact], stdout=PIPE, stderr=STDOUT)
+    p.communicate()
+    assert p.returncode == 0
+    p = Popen(["pydmmt/pydmmt.py", artifact], stdin=PIPE, stdout=PIPE,
+              stderr=STDOUT)
+    output = p.communicate("40 0 20".encode('utf-8'))[0]
+    results = [float(item) for item in output.decode('utf-8').split()]
+    assert abs(results[0] - 3264.858159616) < 0.000001
+    assert abs(results[1] - 1.3017632237375902) < 0.000001
+
+
+def test_pydmmt_constant_folding(tmpdir):
+    import ast
+    from pydmmt import util as ut
+    f = ut.Function("HP[t+1] = 1 * 9.81 * 1000 / 3600000 * h[t] * "
+                    "max( r[t+1] - 0, 0 )")
+    assert f.tree.body.left.left.n == 1 * 9.81 * 1000 / 3600000
+    assert isinstance(f.tree.body.right.args[0], ast.Attribute)
+    assert ut.Function("a[t+1] = 2 ^ 3 * 5 - 1").constant() == 39
+    assert ut.Function("x = 1 if 2 > 3 else 4").constant() == 4
+    assert ut.Function("y = x / 1").constant() is None
+    #
+    source = tmpdir.join("model.yml")
+    source.write('simulation:\n'
+                 '  target: ["h[10]"]\n'
+                 '  inputs: ["k"]\n'
+                 'functions:\n'
+                 '  - "h[t+1] = h[t] + a[t+1] - release"\n'
+                 '  - "release = 2 * k"\n'
+                 '  - "a[t+1] = 40"\n'
+                 '  - "h[0] = 0"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    assert model.sim_fills == [("a", 1, 10, 40)]
+    assert ut.Variable("release") in model.time_invariant
+    for evaluation in ("eager", "lazy"):
+        model.evaluation = evaluation
+        assert model.process_input("5") == "300.0"
+        assert model.process_input("10") == "200.0"
+
+
+def test_pydmmt_vectors(tmpdir):
+    import numpy
+    source = tmpdir.join("model.yml")
+    source.write('constants:\n'
+                 '  L: [[0, 1.6, 1.2], [0.8, 0, 0], [0, 0.7, 0]]\n'
+                 'simulation:\n'
+                 '  target: ["N[10]", "n[10]", "young[10]"]\n'
+                 '  inputs:\n'
+                 '    - "n0": {length: 3}\n'
+                 '  lengths: {n: 3}\n'
+                 'functions:\n'
+                 '  - "n[t+1] = L @ n[t]"\n'
+                 '  - "n[0] = n0"\n'
+                 '  - "N[t] = sum(n[t])"\n'
+                 '  - "young[t] = take(n[t], 0)"\n')
+    leslie = numpy.array([[0, 1.6, 1.2], [0.8, 0, 0], [0, 0.7, 0]])
+    n = numpy.linalg.matrix_power(leslie, 10).dot([40, 0, 20])
+    for evaluation in ("eager", "lazy"):
+        model = pydmmt.Model({"sources": [str(source)]})
+        model.evaluation = evaluation
+        assert model.sim_data.dtype["n"].shape == (3, )
+        results = model.process_values([40, 0, 20])
+        assert numpy.allclose(results, [n.sum()] + list(n) + [n[0]])
+        # same as the scalar equations of leslie.yml
+        results = [float(r) for r in model.process_input("40 0 20").split()]
+        assert abs(results[0] - 875.8826106880001) < 0.000001
+    # derivatives go through vectors as well
+    values, jacobian = model.process_jacobian([40, 0, 20])
+    assert numpy.allclose(jacobian[0],
+                          numpy.linalg.matrix_power(leslie, 10).sum(0))
+
+
+def test_pydmmt_cluster(tmpdir):
+    import numpy
+    import pytest
+    import socket
+    import threading
+    import time
+    from pydmmt import cluster, protocol
+    #
+    source = tmpdir.join("model.yml")
+    source.write('simulation:\n'
+                 '  target: ["y1", "y2"]\n'
+                 '  inputs: ["x1", "x2"]\n'
+                 'functions:\n'
+                 '  - "y1 = x1 + x2"\n'
+                 '  - "y2 = x1 * x2"\n')
+    points = numpy.random.RandomState(0).random_sample((95, 2))
+    with cluster.Coordinator(batch=7, window=2, pending=3) as coordinator:
+        # a worker that takes a unit and leaves without answering
+        def flaky():
+            with socket.create_connection(coordinator.address) as c:
+                protocol.read_frame(c.makefile("rb"))
+        lost = threading.Thread(target=flaky)
+        lost.start()
+        while not coordinator._connections:
+            time.sleep(0.01)
+        results = list()
+        consumer = threading.Thread(target=lambda: results.extend(
+            coordinator.map(iter(points))))
+        consumer.start()
+        lost.join()
+        workers = [threading.Thread(target=cluster.work,
+                                    args=([str(source)], coordinator.address))
+                   for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        consumer.join()
+        results = numpy.array(results)
+        assert numpy.allclose(results[:, 0], points[:, 0] + points[:, 1])
+        assert numpy.allclose(results[:, 1], points[:, 0] * points[:, 1])
+        # the same workers, warm, for the next inputs
+        assert numpy.allclose(list(coordinator.map(points[:3])),
+                              results[:3])
+    for worker in workers:
+        worker.join()
+    # a row that raises stops map, not the worker
+    with cluster.Coordinator(batch=2) as coordinator:
+        worker = threading.Thread(target=cluster.work,
+                                  args=(["examples/calc.yml"],
+                                        coordinator.address))
+        worker.start()
+        with pytest.raises(ValueError, match="Row 3 .*FloatingPointError"):
+            list(coordinator.map([[3, 2], [2, 3], [1, 1], [10, 400]]))
+        assert numpy.allclose(list(coordinator.map([[3, 2]])),
+                              [[5, 9, 3, 5, 2]])
+    worker.join()
+
+
+def test_pydmmt_table(tmpdir):
+    import numpy
+    import pytest
+    from subprocess import Popen, PIPE, STDOUT
+    #
+    model = pydmmt.Model({"sources": ["examples/calc.yml"]})
+    values = numpy.random.RandomState(0).random_sample((50, 2)) * 4
+    values[:5] = [[3, 2], [2, 3], [0, 1], [1, 1], [2.5, 0]]
+    results = model.process_table(values)
+    assert results.shape == (50, 5)
+    for row, targets in zip(values, results):
+        assert model.process_input(' '.join(repr(el) for el in row)) == \
+            ' '.join(str(el) for el in targets)
+    # if expressions, constants, and functions evaluated a row at a time
+    source = tmpdir.join("model.yml")
+    source.write('simulation:\n'
+                 '  target: ["y", "z", "w"]\n'
+                 '  inputs: ["x", "v": {length: 3}]\n'
+                 'functions:\n'
+                 '  - "y = x if x > sum(v) else -x"\n'
+                 '  - "z = 2"\n'
+                 '  - "w = max(v) + dot(v, v)"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    values = numpy.random.RandomState(1).random_sample((20, 4)) * 2
+    results = model.process_table(values)
+    for row, targets in zip(values, results):
+        assert list(model.process_values(row)) == list(targets)
+    with pytest.raises(ValueError):
+        model.process_table(values[:, :3])
+    with pytest.raises(ValueError):
+        pydmmt.Model({"sources": ["examples/fibonacci.yml"]}).process_table(
+            values)
+    # division by zero raises as a row at a time, where it's evaluated
+    source.write('simulation:\n'
+                 '  target: ["y", "z", "w"]\n'
+                 '  inputs: ["x1", "x2"]\n'
+                 'functions:\n'
+                 '  - "y = x1 / x2"\n'
+                 '  - "z = x1 // x2 if x2 > 0 else x1"\n'
+                 '  - "w = x1 * x2"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    with pytest.raises(ZeroDivisionError):
+        model.process_input("1 0")
+    with pytest.raises(ZeroDivisionError):
+        model.process_table([[1, 2], [1, 0]])
+    model.parameters["simulation"]["target"] = model.parameters[
+        "simulation"]["target"][1:]
+    values = [[1, 2], [3, 0], [1e300, 1e300]]
+    assert model.process_table(values).tolist() == [[0, 2], [3, 0],
+                                                    [1, numpy.inf]]
+    assert model.process_input("1e300 1e300") == "1.0 inf"
+    # from the command line
+    inputs = tmpdir.join("inputs.csv")
+    inputs.write("# x1,x2\n3,2\n1,1\n")
+    output = str(tmpdir.join("outputs.csv"))
+    p = Popen(["pydmmt/pydmmt.py", "examples/calc.yml", "--table",
+               str(inputs), output], stdout=PIPE, stderr=STDOUT)
+    p.communicate()
+    assert p.returncode == 0
+    with open(output) as f:
+        assert f.read() == ("# y1,y2,y3,y4,y5\n"
+                            "5.0,9.0,3.0,5.0,2.0\n"
+                            "2.0,1.0,1.0,1.0,1.0\n")
+
+
+def test_pydmmt_kernels(tmpdir):
+    import numpy
+    import pytest
+    from pydmmt import horizon, kernels
+    #
+    # numbers and arrays give the same results
+    a = numpy.random.RandomState(0).random_sample((3, 100)) * 4
+    for f in (kernels.max, kernels.min):
+        assert list(f(a[0], a[1], a[2])) == \
+            [f(x, y, z) for x, y, z in zip(*a.tolist())]
+    assert list(kernels.sum(a.T)) == [sum(x) for x in a.T.tolist()]
+    assert list(kernels.power(a[0], a[1])) == \
+        [x ** y for x, y in zip(a[0].tolist(), a[1].tolist())]
+    assert list(kernels.clip(a[0], 1, 2)) == \
+        [kernels.clip(x, 1, 2) for x in a[0].tolist()]
+    # errors are counted, and raised in bulk
+    errors = kernels.Errors("raise")
+    kernels.use(errors)
+    assert kernels.power(10., 400.) == numpy.inf
+    assert numpy.isnan(kernels.log(numpy.array([-1., 1.]))[0])
+    assert errors.count == 2
+    with pytest.raises(FloatingPointError):
+        errors.check()
+    errors.check()
+    #
+    source = tmpdir.join("model.yml")
+    text = ('simulation:\n'
+            '  target: ["x[3]"]\n'
+            '  inputs: ["a"]\n'
+            '  errors: {}\n'
+            'functions:\n'
+            '  - "x[t+1] = x[t] ^ a"\n'
+            '  - "x[0] = 10"\n')
+    source.write(text.format("raise"))
+    strict = pydmmt.Model({"sources": [str(source)]})
+    assert strict.process_input("2") == "100000000.0"
+    with pytest.raises(FloatingPointError):
+        strict.process_input("200.5")
+    # each model with its own policy, also simulated by a horizon
+    source.write(text.format("nan"))
+    model = pydmmt.Model({"sources": [str(source)]})
+    assert numpy.isnan(
+        horizon.RecedingHorizon(model).evaluate([200.5])[0][0])
+    with pytest.raises(FloatingPointError):
+        strict.process_input("200.5")
+    source.write(text.format("clip"))
+    model = pydmmt.Model({"sources": [str(source)]})
+    assert float(model.process_input("200.5")) == numpy.finfo(float).max
+    # with if expressions the branch not taken is not an error
+    source.write('simulation:\n'
+                 '  target: ["y"]\n'
+                 '  inputs: ["x"]\n'
+                 'functions:\n'
+                 '  - "y = log(x) if x > 0 else 0"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    assert list(model.process_table([[1], [0]])) == [0, 0]
+
+
+def test_pydmmt_pinned_forcing(tmpdir):
+    source = tmpdir.join("model.yml")
+    source.write('simulation:\n'
+                 '  target: ["s[5]"]\n'
+                 '  inputs: ["k"]\n'
+                 'functions:\n'
+                 '  - "s[t+1] = s[t] + k * d[t]"\n'
+                 '  - "s[0] = 0"\n'
+                 '  - "d[t] = t * 2"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    model.evaluation = "eager"
+    assert model.sim_forcing == {"d"}
+    assert len(model.sim_pinned_step_ranges) == \
+        len(model.sim_step_ranges) - 1
+    assert model.process_input("1") == "20.0"
+    # d is computed once, and kept by the next simulations
+    model.sim_data["d"] = 1
+    assert model.process_input("2") == "10.0"
+    model.forget_forcing()
+    assert model.process_input("2") == "40.0"
+    # derivatives don't spoil it
+    values, jacobian = model.process_jacobian([3])
+    assert list(jacobian[0]) == [20]
+    assert model.process_input("3") == "60.0"
+
+
+def test_pydmmt_memory(tmpdir):
+    import io
+    from subprocess import Popen, PIPE, STDOUT
+    from pydmmt import memory
+    #
+    output = io.StringIO()
+    sources = ["examples/leslie_inputs.yml"]
+    report, model = memory.profile(sources, ["40 0 20"] * 2, output)
+    assert output.getvalue().split("\n")[0] == \
+        pydmmt.Model({"sources": sources}).process_input("40 0 20")
+    assert list(report.phases)[:2] == ["external data", "build"]
+    assert report.phases["simulation"][0] == 2
+    assert len(report.steps) == 2 * len(model.sim_timeline)
+    # the values and the mask of what is computed
+    assert report.variables["n1"] == 9 * len(model.sim_timeline)
+    assert all(item[0] > 0 for text, item in report.functions.items()
+               if "[t+1]" in text)
+    assert "Functions" in str(report)
+    # from the command line
+    path = str(tmpdir.join("report.txt"))
+    p = Popen(["pydmmt/pydmmt.py", "examples/calc.yml", "--memory", path],
+              stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+    assert p.communicate(b"3 2\n")[0].split() == \
+        [b"5.0", b"9.0", b"3.0", b"5.0", b"2.0"]
+    with open(path) as f:
+        assert f.read().startswith("Phases")
+
+
+def test_pydmmt_derivatives(tmpdir):
+    import math
+    source = tmpdir.join("model.yml")
+    source.write('simulation:\n'
+                 '  target: ["h[10]", "v[10]"]\n'
+                 '  inputs: ["k"]\n'
+                 'derivatives:\n'
+                 '  - "h\' = a[t+1] - k * h"\n'
+                 '  - "v\' = - h"\n'
+                 'functions:\n'
+                 '  - "h[0] = 100"\n'
+                 '  - "v[0] = 0"\n'
+                 '  - "a[t+1] = 40"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    # exactly: h = 80 + 20 exp(-k t), v = - 80 t - 40 (1 - exp(-k t))
+    for evaluation in ("eager", "lazy"):
+        model.evaluation = evaluation
+        model.system.evaluations = 0
+        h, v = [float(el) for el in model.process_input("0.5").split()]
+        assert abs(h - 80 - 20 * math.exp(-5)) < 1e-4
+        assert abs(v + 800 + 40 * (1 - math.exp(-5))) < 1e-3
+        # both states are integrated at once, with fewer evaluations than
+        # hourly Euler steps
+        assert model.system.evaluations < 10 * 24
+    values, jacobian = model.process_jacobian([0.5])
+    assert abs(jacobian[0][0] + 160 + 40 * math.exp(-5)) < 1e-3
+    # nan stops the integration
+    model.evaluation = "eager"
+    assert model.process_input("nan") == "nan nan"
+    source.write('simulation:\n'
+                 '  target: ["h[1]"]\n'
+                 'derivatives:\n'
+                 '  - "h[t]\' = 1"\n')
+    try:
+        pydmmt.Model({"sources": [str(source)]})
+        assert False
+    except pydmmt.ut.YAMLError:
+        pass
+
+
+def test_pydmmt_logs(tmpdir):
+    import os
+    text = ('simulation:\n'
+            '  target: ["s[3]"]\n'
+            '  inputs: ["k"]\n'
+            '{}'
+            'functions:\n'
+            '  - "s[t+1] = s[t] + k"\n'
+            '  - "s[0] = 0"\n'
+            'logging:\n'
+            '  ' + str(tmpdir.join("out", "s.log")) + ': ["s[t]"]\n')
+    source = tmpdir.join("model.yml")
+    source.write(text.format(''))
+    tmpdir.join("out").mkdir()
+    tmpdir.join("out", "s_4.log").write("")
+    model = pydmmt.Model({"sources": [str(source)]})
+    model.process_input("1")
+    # the directory is listed once: later files are numbered from memory,
+    # skipping the ones written meanwhile
+    tmpdir.join("out", "s_6.log").write("")
+    model.process_input("2")
+    model.process_input("3")
+    assert sorted(os.listdir(str(tmpdir.join("out")))) == \
+        ["s_4.log", "s_5.log", "s_6.log", "s_7.log", "s_8.log"]
+    with open(str(tmpdir.join("out", "s_8.log"))) as f:
+        assert f.read().split() == ["#", "t,s[t]", "0,0.0", "1,3.0",
+                                    "2,6.0", "3,9.0"]
+    # in a new directory for each run, sharded
+    source.write(text.format('  logs: {run: auto, shard: 2}\n'))
+    for run in ("run_1", "run_2"):
+        model = pydmmt.Model({"sources": [str(source)]})
+        for k in range(3):
+            model.process_input(str(k))
+        assert sorted(os.listdir(str(tmpdir.join("out", run, "0")))) == \
+            ["s.log", "s_1.log"]
+        assert os.listdir(str(tmpdir.join("out", run, "1"))) == ["s_2.log"]
+    # packed in a single file, appended to by the next models
+    source.write(text.format('  logs: {pack: true}\n'))
+    for k in range(2):
+        pydmmt.Model({"sources": [str(source)]}).process_input(str(k))
+    with open(str(tmpdir.join("out", "s.log"))) as f:
+        lines = f.read().split("\n")
+    assert lines[0] == "# evaluation,t,s[t]"
+    assert lines[1:5] == ["0,0,0.0", "0,1,0.0", "0,2,0.0", "0,3,0.0"]
+    assert lines[5:9] == ["1,0,0.0", "1,1,1.0", "1,2,2.0", "1,3,3.0"]
+
+
+def test_pydmmt_entry_point():
+    import sys
+    from subprocess import Popen, PIPE
+    p = Popen([sys.executable, "-m", "pydmmt", "examples/calc.yml",
+               "--startup-profile"], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    output, errors = p.communicate(b"3 2\n3 2\n")
+    assert output.split() == [b"5.0", b"9.0", b"3.0", b"5.0", b"2.0"] * 2
+    # reported once, after the first evaluation
+    assert errors.count(b"to first evaluation") == 1
+    # the time waiting on stdin is told apart from the evaluation
+    assert errors.count(b"waiting for inputs") == 1
+    # optional parts aren't imported unless needed
+    p = Popen([sys.executable, "-c", "import sys; from pydmmt import pydmmt;"
+               " print(sorted({'yaml', 'csv', 'concurrent.futures', 'ode',"
+               " 'logs', 'template'} & set(sys.modules)))"], stdout=PIPE)
+    assert p.communicate()[0].split() == [b"[]"]
+    # nor is sys.path changed: modules named as the ones of pydmmt (e.g.
+    # util) are the user's own
+    p = Popen([sys.executable, "-c", "import sys; path = list(sys.path);"
+               " import pydmmt.pydmmt; print(sys.path == path)"],
+              stdout=PIPE)
+    assert p.communicate()[0].split() == [b"True"]
+
+
+def test_pydmmt_gaps(tmpdir):
+    import numpy
+    from pydmmt import gaps
+    data = tmpdir.join("data.csv")
+    data.write("# t,a,b,c,d\n"
+               "0,1,1,1,1\n"
+               "1,,nan,,\n"
+               "2,3,3,5,3\n"
+               "3,,,4,\n"
+               "4,5,5,7,5\n")
+    source = tmpdir.join("model.yml")
+    text = ('simulation:\n'
+            '  target: ["s[6]"]\n'
+            '  inputs: ["k"]\n'
+            'functions:\n'
+            '  - "s[t+1] = s[t] + k * (a[t] + b[t] + c[t] + d[t])"\n'
+            '  - "s[0] = 0"\n'
+            'external:\n'
+            '  ' + str(data) + ':\n'
+            'gaps:\n'
+            '  a: forward\n'
+            '  b: linear\n'
+            '  c: {climatology: 2}\n')
+    source.write(text + '  d: -1\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    assert list(model.sim_data["a"][:6]) == [1, 1, 3, 3, 5, 5]
+    assert list(model.sim_data["b"][:5]) == [1, 2, 3, 4, 5]
+    assert list(model.sim_data["c"][:6]) == [1, 4, 5, 4, 7, 4]
+    assert list(model.sim_data["d"][:6]) == [1, -1, 3, -1, 5, -1]
+    # b has a gap at t = 5 still
+    assert numpy.isnan(model.sim_data["b"][5]) and \
+        not model.sim_known["b"][5]
+    for evaluation in ("eager", "lazy"):
+        model.evaluation = evaluation
+        try:
+            model.process_input("1")
+            assert False
+        except ValueError as error:
+            assert "No value of" in error.args[0]
+    # a number fills a variable with no value at all, too
+    values = numpy.full(3, numpy.nan)
+    known = gaps.fill(values, numpy.zeros(3, dtype=bool), -1)
+    assert known.all() and list(values) == [-1, -1, -1]
+    source.write(text.replace("s[6]", "s[4]") + '  d: -1\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    assert model.process_input("1") == "34.0"
+    source.write(text + '  d: {climatology: 0}\n')
+    try:
+        pydmmt.Model({"sources": [str(source)]})
+        assert False
+    except pydmmt.ut.YAMLError:
+        pass
+    # nan is a value as any other: computed once, as the others
+    source.write('simulation:\n'
+                 '  target: ["m[4]", "p[4]"]\n'
+                 '  inputs: ["k"]\n'
+                 '  errors: nan\n'
+                 '  evaluation: eager\n'
+                 'functions:\n'
+                 '  - "n[t] = log(k)"\n'
+                 '  - "m[t+1] = m[t] + n[t]"\n'
+                 '  - "p[t+1] = p[t] + n[t]"\n'
+                 '  - "m[0] = 0"\n'
+                 '  - "p[0] = 0"\n')
+    model = pydmmt.Model({"sources": [str(source)]})
+    function = model.functions[pydmmt.ut.Variable("n[t]")]
+    calculate = function.calculate
+    calls = list()
+    function.calculate = lambda: calls.append(1) or calculate()
+    model.process_input("2")
+    finite = len(calls)
+    assert model.process_input("-1") == "nan nan"
+    assert len(calls) == 2 * finite